@@ -3,17 +3,28 @@ Flask API for Product Recommendations
 Uses scikit-learn for collaborative filtering and content-based recommendations
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
-import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, pooling
 import numpy as np
+from scipy import sparse
 from sklearn.decomposition import TruncatedSVD
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import StandardScaler, normalize
+import contextvars
+import copy
 import pickle
 import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import shutil
+import uuid
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import json
 
@@ -43,148 +54,1335 @@ DB_CONFIG_LOCAL = {
     'use_unicode': True
 }
 
+# Connection pool shared by all request threads of a worker
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))  # seconds to wait for a free connection
+
+# Hydrated products (as encoded JSON) cached in-process between requests
+PRODUCT_CACHE_SIZE = int(os.getenv('PRODUCT_CACHE_SIZE', 10000))
+PRODUCT_CACHE_TTL = float(os.getenv('PRODUCT_CACHE_TTL', 300))  # seconds
+
+# Product fields a response can be narrowed to with ?fields=, and the SQL
+# behind each; 'card' is what the PHP product card renders
+PRODUCT_FIELDS = {
+    'product_id': 'p.product_id',
+    'seller_id': 'p.seller_id',
+    'category_id': 'p.category_id',
+    'name': 'p.name',
+    'description': 'p.description',
+    'price': 'p.price',
+    'image': 'p.image',
+    'status': 'p.status',
+    'created_at': 'p.created_at',
+    'min_price': 'COALESCE(MIN(ps.price), p.price)',
+    'category_name': 'c.name',
+    'business_name': 's.business_name',
+    'firstname': 's.firstname',
+    'lastname': 's.lastname',
+}
+PRODUCT_JOINS = {
+    'ps': 'LEFT JOIN product_size ps ON p.product_id = ps.product_id',
+    'c': 'LEFT JOIN category c ON p.category_id = c.category_id',
+    's': 'LEFT JOIN seller s ON p.seller_id = s.seller_id',
+}
+FIELD_PRESETS = {
+    'card': ('product_id', 'name', 'image', 'min_price', 'category_name', 'business_name', 'firstname', 'lastname'),
+}
+
+# Customers scored together per chunk by POST /recommendations/batch
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', 64))
+
+# Rows fetched per round trip when streaming training data
+FETCH_BATCH_SIZE = int(os.getenv('FETCH_BATCH_SIZE', 10000))
+
 # Model storage
 MODELS_DIR = 'models'
 os.makedirs(MODELS_DIR, exist_ok=True)
 
-class RecommendationService:
-    def __init__(self):
-        self.db_conn = None
-        self.svd_model = None
-        self.tfidf_vectorizer = None
-        self.product_features = None
-        self.user_item_matrix = None
-        self.user_to_idx = {}
-        self.product_to_idx = {}
-        self.model_trained_at = None
+# Versioned model artifact: one directory of .npy arrays per save plus a JSON
+# manifest naming the current one; workers memory-map the arrays
+ARTIFACT_DIR = os.getenv('ARTIFACT_DIR', f'{MODELS_DIR}/artifact')
+ARTIFACT_FORMAT_VERSION = 1
+ARTIFACT_KEEP = 2  # newest artifact directories kept on disk
+LEGACY_MODEL_PATH = f'{MODELS_DIR}/recommendation_models.pkl'
+
+# Load saved models when app.py is imported (once in the gunicorn master with
+# preload_app), and check for newer artifacts from other workers every
+# MODEL_RELOAD_INTERVAL seconds (0 disables the check)
+PRELOAD_MODELS = os.getenv('PRELOAD_MODELS', '1') != '0'
+MODEL_RELOAD_INTERVAL = float(os.getenv('MODEL_RELOAD_INTERVAL', 15))
+# A failed first-start training is retried by the watchers only after this
+FIRST_TRAINING_RETRY_SECONDS = float(os.getenv('FIRST_TRAINING_RETRY_SECONDS', 600))
+
+# Status files of background training jobs; only the newest JOBS_KEEP
+# finished jobs are kept
+JOBS_DIR = f'{MODELS_DIR}/jobs'
+JOBS_KEEP = int(os.getenv('JOBS_KEEP', 50))
+
+# Incremental training folds new data into the existing model; a full retrain
+# is forced once the last one is older than this
+FULL_RETRAIN_INTERVAL_HOURS = float(os.getenv('FULL_RETRAIN_INTERVAL_HOURS', 24))
+# Incremental runs re-read the customers with orders changed in this window
+# before the last update, so orders paid or delivered a while after they
+# were placed are picked up. Set ORDERS_CHANGED_COLUMN to an update
+# timestamp (e.g. updated_at) if the orders table has one.
+INCREMENTAL_ORDER_LOOKBACK_DAYS = float(os.getenv('INCREMENTAL_ORDER_LOOKBACK_DAYS', 14))
+ORDERS_CHANGED_COLUMN = os.getenv('ORDERS_CHANGED_COLUMN', 'created_at')
+if not re.fullmatch(r'\w+', ORDERS_CHANGED_COLUMN):
+    raise ValueError(f"ORDERS_CHANGED_COLUMN must be a column name, got {ORDERS_CHANGED_COLUMN!r}")
+
+# Top-N hybrid recommendations precomputed offline by precompute_recommendations.py
+PRECOMPUTED_DIR = os.getenv('PRECOMPUTED_DIR', f'{MODELS_DIR}/precomputed')
+PRECOMPUTED_CHECK_INTERVAL = float(os.getenv('PRECOMPUTED_CHECK_INTERVAL', 30))  # seconds between manifest checks
+
+# Ranked recommendation lists cached per model version:
+# 'memory' (per worker), 'file' (SQLite file shared by all workers) or 'none'
+RESULT_CACHE_BACKEND = os.getenv('RESULT_CACHE_BACKEND', 'memory')
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 50000))
+RESULT_CACHE_PATH = os.getenv('RESULT_CACHE_PATH', f'{MODELS_DIR}/result_cache.sqlite3')
+
+# Product invalidations are appended here so every worker's product cache
+# drops them on its next lookup; the log is started over past the size limit
+PRODUCT_INVALIDATION_LOG = os.getenv('PRODUCT_INVALIDATION_LOG', f'{MODELS_DIR}/product_invalidations.log')
+PRODUCT_INVALIDATION_LOG_BYTES = int(os.getenv('PRODUCT_INVALIDATION_LOG_BYTES', 1 << 20))
+
+# Item-to-item neighbor table built at training time for /similar
+SIMILAR_NEIGHBORS = int(os.getenv('SIMILAR_NEIGHBORS', 50))  # neighbors kept per product
+NEIGHBOR_BLOCK_BYTES = int(os.getenv('NEIGHBOR_BLOCK_BYTES', 256 * 1024 * 1024))  # scoring memory, all workers
+TRAINING_WORKERS = int(os.getenv('TRAINING_WORKERS', os.cpu_count() or 1))
+
+# Collaborative filtering trainer: 'svd' (TruncatedSVD) or 'als' (implicit-feedback
+# alternating least squares, solved in parallel blocks on TRAINING_WORKERS threads)
+CF_TRAINER = os.getenv('CF_TRAINER', 'svd')
+CF_FACTORS = int(os.getenv('CF_FACTORS', 50))  # latent factors
+ALS_ITERATIONS = int(os.getenv('ALS_ITERATIONS', 15))
+ALS_REGULARIZATION = float(os.getenv('ALS_REGULARIZATION', 0.1))
+ALS_ALPHA = float(os.getenv('ALS_ALPHA', 10))  # confidence = 1 + alpha * log(1 + weight)
+ALS_CG_STEPS = int(os.getenv('ALS_CG_STEPS', 3))  # conjugate gradient steps per solve
+ALS_BLOCK_SIZE = int(os.getenv('ALS_BLOCK_SIZE', 4096))  # rows solved per block
+
+# Similar-user search: 'exact' scans every user, 'ivf' uses an approximate index
+USER_INDEX = os.getenv('USER_INDEX', 'exact')
+USER_INDEX_LISTS = int(os.getenv('USER_INDEX_LISTS', 0))  # 0 = sqrt(number of users)
+USER_INDEX_NPROBE = int(os.getenv('USER_INDEX_NPROBE', 8))  # lists scanned per query; higher = better recall
+
+# Histogram buckets (seconds) of the request, stage and training timings at /metrics
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Hybrid branches: 'concurrent' runs collaborative filtering and the content
+# branch (history query + scoring) side by side on a shared thread pool;
+# a branch that misses its deadline is dropped and the other one's results used.
+# Only used with HYBRID_RETRIEVAL=full or for models without a history index;
+# two-stage retrieval below runs inline and takes precedence
+HYBRID_EXECUTION = os.getenv('HYBRID_EXECUTION', 'concurrent')  # or 'sequential'
+HYBRID_POOL_SIZE = int(os.getenv('HYBRID_POOL_SIZE', 8))
+HYBRID_CF_TIMEOUT = float(os.getenv('HYBRID_CF_TIMEOUT', 0.5))  # seconds
+HYBRID_CONTENT_TIMEOUT = float(os.getenv('HYBRID_CONTENT_TIMEOUT', 1.0))  # seconds
+
+# Hybrid retrieval: 'two_stage' gathers a bounded candidate set (similar users'
+# items, item-item neighbors of the customer's history, popular products of
+# the history's categories) and re-ranks only that; 'full' scores the catalog
+HYBRID_RETRIEVAL = os.getenv('HYBRID_RETRIEVAL', 'two_stage')
+CANDIDATES_CF = int(os.getenv('CANDIDATES_CF', 200))  # similar users' items kept
+CANDIDATES_HISTORY_ITEMS = int(os.getenv('CANDIDATES_HISTORY_ITEMS', 20))  # history items expanded (closest to the profile)
+CANDIDATES_PER_ITEM = int(os.getenv('CANDIDATES_PER_ITEM', 20))  # neighbors taken per history item
+CANDIDATES_PER_CATEGORY = int(os.getenv('CANDIDATES_PER_CATEGORY', 50))  # popular products per category
+CANDIDATES_MAX = int(os.getenv('CANDIDATES_MAX', 500))  # candidates re-ranked per request
+
+# Search-driven retrieval: each customer's recent searches become a weighted
+# TF-IDF term vector, matched through an inverted index (term -> product rows)
+SEARCH_TERMS_PER_QUERY = int(os.getenv('SEARCH_TERMS_PER_QUERY', 10))  # strongest terms looked up
+SEARCH_POSTINGS_PER_TERM = int(os.getenv('SEARCH_POSTINGS_PER_TERM', 200))  # best products read per term
+CANDIDATES_SEARCH = int(os.getenv('CANDIDATES_SEARCH', 50))  # hybrid candidates from searches
+
+# Cold start: customers with no orders, views or searches are answered from
+# popularity tables built at training time (orders plus weighted views,
+# scaled by average rating), without scoring or a history query
+COLD_START_SIZE = int(os.getenv('COLD_START_SIZE', 200))  # products kept per table
+POPULARITY_VIEW_WEIGHT = float(os.getenv('POPULARITY_VIEW_WEIGHT', 0.1))  # one view counts as this many orders
+TRENDING_DAYS = int(os.getenv('TRENDING_DAYS', 7))
+
+def build_id_index(id_to_idx):
+    """Build array-backed inverse of an id -> row dict: (idx_to_id, sorter)"""
+    idx_to_id = np.zeros(len(id_to_idx), dtype=np.int64)
+    for item_id, idx in id_to_idx.items():
+        idx_to_id[idx] = item_id
+    return idx_to_id, np.argsort(idx_to_id, kind='stable')
+
+def lookup_indices(idx_to_id, sorter, ids):
+    """Vectorized id -> row lookup by binary search; unknown ids map to -1"""
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(idx_to_id) == 0:
+        return np.full(ids.shape, -1, dtype=np.int64)
+    pos = np.searchsorted(idx_to_id, ids, sorter=sorter)
+    pos = np.minimum(pos, len(idx_to_id) - 1)
+    rows = sorter[pos]
+    return np.where(idx_to_id[rows] == ids, rows, -1)
+
+def contains_sorted(values, item):
+    """True if item is in the sorted array values"""
+    pos = np.searchsorted(values, item)
+    return pos < len(values) and values[pos] == item
+
+def parse_fields(value):
+    """Normalized field projection from 'card' or 'name,image,...' (None = every column).
+    
+    Raises ValueError for unknown fields. product_id is always included.
+    """
+    if not value:
+        return None
+    names = value.split(',') if isinstance(value, str) else list(value)
+    fields = set()
+    for name in (str(name).strip() for name in names):
+        if name in FIELD_PRESETS:
+            fields.update(FIELD_PRESETS[name])
+        elif name in PRODUCT_FIELDS:
+            fields.add(name)
+        elif name:
+            raise ValueError(f"Unknown field '{name}'; use {', '.join(list(FIELD_PRESETS) + list(PRODUCT_FIELDS))}")
+    fields.add('product_id')
+    return tuple(sorted(fields))
+
+def hydrate_query(fields, placeholders):
+    """Product details query selecting only `fields` (all columns if None) and the joins they need"""
+    if fields is None:
+        columns = """p.*, 
+                   COALESCE(MIN(ps.price), p.price) as min_price,
+                   c.name as category_name,
+                   s.business_name, s.firstname, s.lastname"""
+        fields = tuple(PRODUCT_FIELDS)
+    else:
+        columns = ', '.join(f'{PRODUCT_FIELDS[name]} as {name}' for name in fields)
+    aliases = set(re.findall(r'\b(\w+)\.', ' '.join(PRODUCT_FIELDS[name] for name in fields)))
+    joins = '\n        '.join(join for alias, join in PRODUCT_JOINS.items() if alias in aliases)
+    # Products have several sizes; min_price aggregates them
+    group_by = 'GROUP BY p.product_id' if 'ps' in aliases else ''
+    return f"""
+        SELECT {columns}
+        FROM product p
+        {joins}
+        WHERE p.product_id IN ({placeholders})
+        AND p.status = 'active'
+        {group_by}
+    """
+
+def json_with_products(fields, fragments):
+    """JSON response of fields plus a 'products' list of already-encoded product JSON"""
+    head = app.json.dumps(fields)
+    body = f'{head[:-1]}, "products": [{", ".join(fragments)}]}}\n'
+    return Response(body, mimetype=app.json.mimetype)
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+class Metrics:
+    """Counters and histograms rendered in the Prometheus text format.
+    
+    Kept per process: each gunicorn worker reports its own numbers.
+    """
+    
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self._counters = {}  # (name, labels) -> value
+        self._lock = threading.Lock()
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def render(self, samples=()):
+        """Exposition text; samples are extra (name, type, labels, value) read at scrape time"""
+        def sample(name, labels, value):
+            label_text = ','.join(
+                '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels
+            )
+            return f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}'
+        
+        with self._lock:
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
         
-    def get_db_connection(self):
-        """Get database connection"""
+        lines = []
+        typed = set()
+        for (name, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(sample(f'{name}_bucket', labels + (('le', bound),), bucket_count))
+            lines.append(sample(f'{name}_bucket', labels + (('le', '+Inf'),), count))
+            lines.append(sample(f'{name}_sum', labels, round(total, 6)))
+            lines.append(sample(f'{name}_count', labels, count))
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            lines.append(sample(name, labels, value))
+        for name, kind, labels, value in samples:
+            if name not in typed:
+                lines.append(f'# TYPE {name} {kind}')
+                typed.add(name)
+            lines.append(sample(name, tuple(labels), value))
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+
+# Stage durations of the current request, for its Server-Timing header
+# (copied into hybrid branch threads so their stages are included)
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+def record_stage(stage, seconds):
+    """Add a stage duration to the metrics and the current request's timings"""
+    METRICS.observe('recommendation_stage_duration_seconds', seconds, stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+# Column layouts (SELECT order) of the streamed training queries; object
+# columns stay Python lists, NULLs in integer columns become -1
+INTERACTION_COLUMNS = [
+    ('customer_id', np.int64),
+    ('product_id', np.int64),
+    ('total_quantity', np.float32),
+    ('order_count', np.float32),
+]
+PRODUCT_COLUMNS = [
+    ('product_id', np.int64),
+    ('name', object),
+    ('description', object),
+    ('category_id', np.int64),
+    ('price', np.float32),
+    ('category_name', object),
+    ('avg_rating', np.float32),
+    ('purchase_count', np.int32),
+]
+HISTORY_COLUMNS = [
+    ('customer_id', np.int64),
+    ('product_id', np.int64),
+]
+SEARCH_COLUMNS = [
+    ('customer_id', np.int64),
+    ('search_term', object),
+    ('category_id', np.int64),
+    ('search_count', np.int32),
+]
+POPULARITY_COLUMNS = [
+    ('product_id', np.int64),
+    ('popularity', np.float32),
+    ('trending', np.float32),
+]
+
+def fetch_columns(cursor, columns, batch_size=FETCH_BATCH_SIZE):
+    """Stream a tuple cursor's result set into {name: typed array} in fixed-size batches"""
+    parts = {name: [] for name, _ in columns}
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for (name, dtype), values in zip(columns, zip(*rows)):
+            if dtype is object:
+                parts[name].extend(values)
+                continue
+            values = np.array(values, dtype=np.float64)
+            if np.issubdtype(dtype, np.integer):
+                values = np.where(np.isnan(values), -1, values)
+            parts[name].append(values.astype(dtype))
+    
+    return {
+        name: parts[name] if dtype is object else (
+            np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype=dtype)
+        )
+        for name, dtype in columns
+    }
+
+def row_count(columns):
+    """Number of rows in a {name: array} column set (0 for None)"""
+    if not columns:
+        return 0
+    return len(next(iter(columns.values())))
+
+def product_texts(products):
+    """TF-IDF input text for each product: name, description and category"""
+    return [
+        f"{name} {description or ''} {category_name or ''}"
+        for name, description, category_name in zip(
+            products['name'], products['description'], products['category_name']
+        )
+    ]
+
+class IdMap(Mapping):
+    """Read-only id -> row mapping backed by an idx_to_id array and its argsort.
+    
+    Used instead of a dict for memory-mapped models, so the ID maps are shared
+    between worker processes instead of rebuilt in each of them.
+    """
+    
+    def __init__(self, idx_to_id, sorter):
+        self.idx_to_id = idx_to_id
+        self.sorter = sorter
+    
+    def __getitem__(self, item_id):
+        row = lookup_indices(self.idx_to_id, self.sorter, [item_id])[0]
+        if row < 0:
+            raise KeyError(item_id)
+        return int(row)
+    
+    def __contains__(self, item_id):
         try:
-            if self.db_conn is None or not self.db_conn.is_connected():
-                try:
-                    # Try production config first
-                    self.db_conn = mysql.connector.connect(**DB_CONFIG)
-                except Error:
-                    # Fallback to local XAMPP config
-                    print("Trying local XAMPP database configuration...")
-                    try:
-                        # Add connection arguments to handle collation issues
-                        local_config = DB_CONFIG_LOCAL.copy()
-                        self.db_conn = mysql.connector.connect(
-                            host=local_config['host'],
-                            database=local_config['database'],
-                            user=local_config['user'],
-                            password=local_config['password'],
-                            charset='utf8mb4',
-                            collation='utf8mb4_unicode_ci',
-                            use_unicode=True,
-                            sql_mode=''
-                        )
-                    except Error as e:
-                        print(f"Error connecting to database: {e}")
-                        print("\nPlease check:")
-                        print("1. MySQL/XAMPP is running")
-                        print("2. Database credentials in app.py are correct")
-                        print("3. Database exists and is accessible")
-                        return None
-            return self.db_conn
+            return lookup_indices(self.idx_to_id, self.sorter, [item_id])[0] >= 0
+        except (TypeError, ValueError):
+            return False
+    
+    def __iter__(self):
+        return iter(self.idx_to_id.tolist())
+    
+    def __len__(self):
+        return len(self.idx_to_id)
+    
+    def items(self):
+        return zip(self.idx_to_id.tolist(), range(len(self.idx_to_id)))
+
+def build_history_index(customer_ids, product_ids):
+    """CSR-style customer -> products index: (sorted customer IDs, indptr, product IDs)"""
+    customer_ids = np.asarray(customer_ids, dtype=np.int64)
+    product_ids = np.asarray(product_ids, dtype=np.int64)
+    valid = (customer_ids >= 0) & (product_ids >= 0)
+    customer_ids, product_ids = customer_ids[valid], product_ids[valid]
+    
+    order = np.lexsort((product_ids, customer_ids))
+    customer_ids, product_ids = customer_ids[order], product_ids[order]
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = (customer_ids[1:] != customer_ids[:-1]) | (product_ids[1:] != product_ids[:-1])
+    customer_ids, product_ids = customer_ids[keep], product_ids[keep]
+    
+    customers, starts = np.unique(customer_ids, return_index=True)
+    indptr = np.append(starts, len(product_ids)).astype(np.int64)
+    return customers, indptr, product_ids
+
+def build_category_index(categories, popularity):
+    """Content rows grouped by category, most popular first: (category IDs, indptr, rows)"""
+    categories = np.asarray(categories, dtype=np.int64)
+    order = np.lexsort((-np.asarray(popularity, dtype=np.float32), categories))
+    category_ids, starts = np.unique(categories[order], return_index=True)
+    return category_ids, np.append(starts, len(order)).astype(np.int64), order.astype(np.int64)
+
+def write_artifact(arrays, meta, objects, root=ARTIFACT_DIR, keep=ARTIFACT_KEEP):
+    """Write a new artifact directory and atomically point the manifest at it.
+    
+    arrays: {name: ndarray} saved as <name>.npy; objects: {name: picklable}
+    saved as <name>.pkl (small fitted estimators); meta is stored in the manifest.
+    """
+    os.makedirs(root, exist_ok=True)
+    directory = 'v' + datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    path = os.path.join(root, directory)
+    os.makedirs(path)
+    
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), np.ascontiguousarray(array))
+    for name, obj in objects.items():
+        with open(os.path.join(path, f'{name}.pkl'), 'wb') as f:
+            pickle.dump(obj, f)
+    
+    manifest = dict(meta, format_version=ARTIFACT_FORMAT_VERSION, directory=directory,
+                    arrays=sorted(arrays), objects=sorted(objects))
+    # Unique per writer, so concurrent trainings never share a temp file
+    tmp_path = os.path.join(root, f'manifest.json.{os.getpid()}.{uuid.uuid4().hex}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(root, 'manifest.json'))
+    
+    # Drop old versions; processes still mapping them keep their pages
+    versions = sorted(name for name in os.listdir(root) if name.startswith('v'))
+    for name in versions[:-keep]:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    
+    return manifest
+
+def read_artifact(root=ARTIFACT_DIR, mmap_mode='r'):
+    """Read the current artifact: (manifest, {name: memory-mapped array}, {name: object})"""
+    with open(os.path.join(root, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != ARTIFACT_FORMAT_VERSION:
+        raise ValueError(f"Unsupported model artifact format {manifest.get('format_version')}")
+    
+    path = os.path.join(root, manifest['directory'])
+    arrays = {
+        name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+        for name in manifest['arrays']
+    }
+    objects = {}
+    for name in manifest['objects']:
+        with open(os.path.join(path, f'{name}.pkl'), 'rb') as f:
+            objects[name] = pickle.load(f)
+    return manifest, arrays, objects
+
+def merge_hybrid(cf_recs, cb_recs, n_recommendations):
+    """Merge ranked CF and content lists, weighting collaborative filtering more"""
+    combined = {}
+    
+    for idx, product_id in enumerate(cf_recs):
+        combined[product_id] = combined.get(product_id, 0) + (len(cf_recs) - idx) * 2
+    
+    for idx, product_id in enumerate(cb_recs):
+        combined[product_id] = combined.get(product_id, 0) + (len(cb_recs) - idx)
+    
+    # Sort by score
+    sorted_products = sorted(combined.items(), key=lambda x: x[1], reverse=True)
+    return [product_id for product_id, score in sorted_products[:n_recommendations]]
+
+def build_neighbor_table(vectors, k, max_bytes=NEIGHBOR_BLOCK_BYTES, workers=TRAINING_WORKERS, start_row=0):
+    """Top-k cosine neighbors of rows start_row.. of an L2-normalized CSR matrix.
+    
+    Rows are scored against all rows in blocks sized so that the blocks of
+    all workers together stay within about max_bytes. Returns (neighbor
+    rows, scores), padded with -1 / -inf.
+    """
+    n = vectors.shape[0]
+    k = max(0, min(k, n - 1))
+    neighbor_idx = np.full((n - start_row, k), -1, dtype=np.int32)
+    neighbor_scores = np.full((n - start_row, k), -np.inf, dtype=np.float32)
+    if k == 0:
+        return neighbor_idx, neighbor_scores
+    
+    # Per scored row: up to n sparse products (8 bytes each) while they are
+    # converted to n dense float32 scores
+    block_size = max(1, max_bytes // (12 * n * max(1, workers)))
+    select_rows = 64  # rows per argpartition, whose int64 output is n wide
+    vectors_t = vectors.T.tocsc()
+    
+    def score_block(start):
+        end = min(start + block_size, n)
+        # Negated in place, so the smallest values are the best neighbors
+        block = (vectors[start:end] @ vectors_t).toarray()
+        np.negative(block, out=block)
+        block[np.arange(end - start), np.arange(start, end)] = np.inf
+        for offset in range(0, end - start, select_rows):
+            rows = block[offset:offset + select_rows]
+            top = np.argpartition(rows, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(rows, top, axis=1)
+            order = np.argsort(top_scores, axis=1, kind='stable')
+            first = start - start_row + offset
+            neighbor_idx[first:first + len(rows)] = np.take_along_axis(top, order, axis=1)
+            neighbor_scores[first:first + len(rows)] = -np.take_along_axis(top_scores, order, axis=1)
+    
+    starts = range(start_row, n, block_size)
+    if workers > 1 and n - start_row > block_size:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(score_block, starts))
+    else:
+        for start in starts:
+            score_block(start)
+    
+    return neighbor_idx, neighbor_scores
+
+def als_confidence(matrix, alpha=ALS_ALPHA):
+    """Confidence minus one (alpha * log(1 + weight)) of each interaction, same sparsity"""
+    confidence = matrix.copy()
+    confidence.data = (alpha * np.log1p(confidence.data)).astype(np.float32)
+    return confidence
+
+def als_solve(confidence, fixed, solved, regularization=ALS_REGULARIZATION,
+              cg_steps=ALS_CG_STEPS, block_size=ALS_BLOCK_SIZE, workers=TRAINING_WORKERS):
+    """Update solved in place for one ALS half-step against the fixed factors.
+    
+    confidence is the (rows x columns) CSR matrix of confidence - 1. Each row
+    solves (F'F + F' (C - I) F + reg I) x = F' C p with a few conjugate
+    gradient steps warm-started from the current x; a block of rows is
+    solved at once with sparse/dense matrix products, and blocks run on a
+    thread pool.
+    """
+    n = confidence.shape[0]
+    gram = fixed.T @ fixed + regularization * np.eye(fixed.shape[1], dtype=fixed.dtype)
+    
+    def solve_block(start):
+        end = min(start + block_size, n)
+        block = confidence[start:end]
+        owner = np.repeat(np.arange(end - start), np.diff(block.indptr))
+        items = fixed[block.indices]
+        
+        def apply(p):
+            weights = np.einsum('ij,ij->i', items, p[owner]) * block.data
+            weighted = sparse.csr_matrix((weights, block.indices, block.indptr), shape=block.shape)
+            return p @ gram + weighted @ fixed
+        
+        # Right-hand side F' C p: every stored entry has preference 1
+        ones = sparse.csr_matrix((block.data + 1, block.indices, block.indptr), shape=block.shape)
+        x = solved[start:end].copy()
+        r = ones @ fixed - apply(x)
+        p = r.copy()
+        r_norm = np.einsum('ij,ij->i', r, r)
+        for _ in range(cg_steps):
+            ap = apply(p)
+            step = r_norm / np.maximum(np.einsum('ij,ij->i', p, ap), 1e-12)
+            x += step[:, None] * p
+            r -= step[:, None] * ap
+            new_norm = np.einsum('ij,ij->i', r, r)
+            p = r + (new_norm / np.maximum(r_norm, 1e-12))[:, None] * p
+            r_norm = new_norm
+        solved[start:end] = x
+    
+    starts = range(0, n, block_size)
+    if workers > 1 and n > block_size:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(solve_block, starts))
+    else:
+        for start in starts:
+            solve_block(start)
+
+def train_als(matrix, factors=CF_FACTORS, iterations=ALS_ITERATIONS, progress=None, seed=42):
+    """Implicit-feedback ALS on a users x products weight matrix.
+    
+    Returns (user factors, product factors). progress(fraction) is called
+    after every iteration.
+    """
+    confidence = als_confidence(matrix)
+    confidence_t = confidence.T.tocsr()
+    rng = np.random.default_rng(seed)
+    user_factors = (rng.standard_normal((matrix.shape[0], factors)) * 0.01).astype(np.float32)
+    item_factors = (rng.standard_normal((matrix.shape[1], factors)) * 0.01).astype(np.float32)
+    
+    for iteration in range(iterations):
+        als_solve(confidence, item_factors, user_factors)
+        als_solve(confidence_t, user_factors, item_factors)
+        if progress:
+            progress((iteration + 1) / iterations)
+    
+    return user_factors, item_factors
+
+class IVFIndex:
+    """Inverted-file ANN index over L2-normalized vectors.
+    
+    Vectors are clustered with spherical k-means; a query only scores the
+    members of the n_probe lists whose centroids are closest to it.
+    """
+    
+    def __init__(self, centroids, list_offsets, list_members):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_members = list_members
+    
+    @classmethod
+    def build(cls, vectors, n_lists=0, n_iter=10, sample_size=100000, seed=42):
+        """Cluster vectors into n_lists inverted lists"""
+        n = vectors.shape[0]
+        if n_lists <= 0:
+            n_lists = int(np.sqrt(n))
+        n_lists = max(1, min(n_lists, n))
+        
+        # Fit centroids on a sample, then assign every vector
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n, min(n, sample_size), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = normalize(sums).astype(np.float32)
+        
+        return cls.from_centroids(centroids, vectors)
+    
+    @classmethod
+    def from_centroids(cls, centroids, vectors):
+        """Assign every vector to its closest centroid's list"""
+        assignment = np.concatenate([
+            np.argmax(vectors[start:start + 65536] @ centroids.T, axis=1)
+            for start in range(0, vectors.shape[0], 65536)
+        ])
+        list_members = np.argsort(assignment, kind='stable').astype(np.int32)
+        list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=len(centroids)), out=list_offsets[1:])
+        return cls(centroids, list_offsets, list_members)
+    
+    def search(self, vectors, query, k, n_probe=USER_INDEX_NPROBE, exclude=-1):
+        """Approximate top-k rows of vectors by inner product with query"""
+        probe = top_k(self.centroids @ query, n_probe)
+        candidates = np.concatenate([
+            self.list_members[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probe
+        ])
+        candidates = candidates[candidates != exclude]
+        scores = vectors[candidates] @ query
+        top = top_k(scores, k)
+        return candidates[top], scores[top]
+
+class ConnectionPool:
+    """Bounded, thread-safe MySQL connection pool.
+    
+    The database config (production, else local XAMPP) is resolved once when
+    the pool is first used. Connections are health-checked on checkout and
+    callers wait at most `timeout` seconds for a free one.
+    """
+    
+    def __init__(self, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self.stats = {
+            'acquired': 0,
+            'timeouts': 0,
+            'errors': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+        }
+        if hasattr(os, 'register_at_fork'):
+            # Sockets must not be shared with forked workers
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+    
+    def _reset_after_fork(self):
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.size)
+    
+    def _create_pool(self):
+        """Open the pool, falling back to the local XAMPP config"""
+        try:
+            # Try production config first
+            return pooling.MySQLConnectionPool(
+                pool_name='recommendations', pool_size=self.size, **DB_CONFIG
+            )
+        except Error:
+            # Fallback to local XAMPP config
+            print("Trying local XAMPP database configuration...")
+            try:
+                # Add connection arguments to handle collation issues
+                return pooling.MySQLConnectionPool(
+                    pool_name='recommendations_local',
+                    pool_size=self.size,
+                    host=DB_CONFIG_LOCAL['host'],
+                    database=DB_CONFIG_LOCAL['database'],
+                    user=DB_CONFIG_LOCAL['user'],
+                    password=DB_CONFIG_LOCAL['password'],
+                    charset='utf8mb4',
+                    collation='utf8mb4_unicode_ci',
+                    use_unicode=True,
+                    sql_mode=''
+                )
+            except Error as e:
+                print(f"Error connecting to database: {e}")
+                print("\nPlease check:")
+                print("1. MySQL/XAMPP is running")
+                print("2. Database credentials in app.py are correct")
+                print("3. Database exists and is accessible")
+                return None
+    
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = self._create_pool()
+        return self._pool
+    
+    def _checkout(self):
+        """Take a live connection from the pool (None on failure)"""
+        pool = self._get_pool()
+        if pool is None:
+            return None
+        
+        conn = None
+        try:
+            conn = pool.get_connection()
+            if not conn.is_connected():
+                conn.reconnect(attempts=2, delay=0)
+            return conn
         except Error as e:
             print(f"Error connecting to database: {e}")
+            with self._lock:
+                self.stats['errors'] += 1
+            if conn is not None:
+                conn.close()
             return None
     
-    def load_training_data(self):
-        """Load data from database for training"""
-        conn = self.get_db_connection()
-        if not conn:
-            return None, None, None
-        
-        cursor = conn.cursor(dictionary=True)
-        
-        # Get user-item interactions (purchases)
-        cursor.execute("""
-            SELECT customer_id, product_id, SUM(quantity) as total_quantity, COUNT(*) as order_count
-            FROM orders
-            WHERE status IN ('delivered', 'completed', 'confirmed', 'preparing', 'packed', 'for_pickup', 'out_for_delivery')
-            AND payment_status = 'paid'
-            GROUP BY customer_id, product_id
-        """)
-        interactions = cursor.fetchall()
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled connection; yields None if none is available"""
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            record_stage('db_wait', time.perf_counter() - start)
+            with self._lock:
+                self.stats['timeouts'] += 1
+            print(f"Timed out after {self.timeout}s waiting for a database connection")
+            yield None
+            return
         
-        # Get product features
-        cursor.execute("""
-            SELECT p.product_id, p.name, p.description, p.category_id, p.price,
-                   c.name as category_name,
-                   COALESCE(AVG(r.rating), 0) as avg_rating,
-                   COUNT(DISTINCT o.orders_id) as purchase_count
-            FROM product p
-            LEFT JOIN category c ON p.category_id = c.category_id
-            LEFT JOIN orders o ON p.product_id = o.product_id 
-                AND o.status IN ('delivered', 'completed', 'confirmed')
-            LEFT JOIN rating r ON o.orders_id = r.orders_id
-            WHERE p.status = 'active'
-            AND (p.moderation_status = 'approved' OR p.moderation_status IS NULL)
-            GROUP BY p.product_id
-        """)
-        products = cursor.fetchall()
-        
-        # Get user searches
-        cursor.execute("""
-            SELECT customer_id, search_term, category_id, COUNT(*) as search_count
-            FROM user_searches
-            WHERE created_at >= DATE_SUB(NOW(), INTERVAL 90 DAY)
-            GROUP BY customer_id, search_term, category_id
+        waited = time.perf_counter() - start
+        METRICS.observe('recommendation_db_pool_wait_seconds', waited)
+        with self._lock:
+            self.stats['acquired'] += 1
+            self.stats['wait_seconds_total'] += waited
+            self.stats['wait_seconds_max'] = max(self.stats['wait_seconds_max'], waited)
+        
+        conn = None
+        try:
+            conn = self._checkout()
+            record_stage('db_wait', time.perf_counter() - start)
+            yield conn
+        finally:
+            try:
+                if conn is not None:
+                    # Returns it to the pool; the session reset fails on a
+                    # dropped connection or unread results
+                    conn.close()
+            except Error as e:
+                print(f"Error returning a database connection to the pool: {e}")
+            finally:
+                # The slot must come back even when the reset fails
+                self._slots.release()
+
+class ProductCache:
+    """Thread-safe LRU cache of hydrated products (encoded JSON) with a TTL.
+    
+    Entries are kept per field projection (None = every column). Products
+    that were not found (inactive or deleted) are cached as None so they do
+    not hit the database on every request either.
+    
+    Each worker has its own cache. Invalidations are appended to a log file
+    (one line of product IDs, or '*' for everything) that every worker reads
+    from its last position before a lookup. A new log file (different inode)
+    means the log was started over, and the whole cache is dropped.
+    """
+    
+    def __init__(self, max_size=PRODUCT_CACHE_SIZE, ttl=PRODUCT_CACHE_TTL,
+                 log_path=PRODUCT_INVALIDATION_LOG, max_log_bytes=PRODUCT_INVALIDATION_LOG_BYTES):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.log_path = log_path
+        self.max_log_bytes = max_log_bytes
+        self._entries = OrderedDict()  # (fields, product_id) -> (expires_at, product JSON)
+        self._lock = threading.Lock()
+        self._log_inode, self._log_offset = self._log_end()
+        self.hits = 0
+        self.misses = 0
+    
+    def _log_end(self):
+        try:
+            stat = os.stat(self.log_path)
+        except OSError:
+            return None, 0
+        return stat.st_ino, stat.st_size
+    
+    def _drop(self, product_ids):
+        if product_ids is None:
+            count = len(self._entries)
+            self._entries.clear()
+            return count
+        product_ids = set(product_ids)
+        keys = [key for key in self._entries if key[1] in product_ids]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+    
+    def _sync(self):
+        """Apply invalidations logged by any worker since the last lookup (lock held)"""
+        inode, size = self._log_end()
+        if inode is None or (inode == self._log_inode and size <= self._log_offset):
+            return
+        if inode != self._log_inode:
+            if self._log_inode is not None:
+                self._drop(None)
+                self._log_inode, self._log_offset = inode, size
+                return
+            # The first invalidation since startup created the log
+            self._log_inode, self._log_offset = inode, 0
+        try:
+            with open(self.log_path, 'rb') as f:
+                f.seek(self._log_offset)
+                data = f.read(size - self._log_offset)
+        except OSError as e:
+            print(f"Product invalidation log read failed: {e}")
+            return
+        # A line still being appended is read on the next lookup
+        data = data[:data.rfind(b'\n') + 1]
+        self._log_offset += len(data)
+        for line in data.split():
+            try:
+                self._drop(None if line == b'*' else [int(pid) for pid in line.split(b',')])
+            except ValueError:
+                self._drop(None)
+    
+    def _log(self, product_ids):
+        line = '*' if product_ids is None else ','.join(str(pid) for pid in product_ids)
+        try:
+            if os.path.getsize(self.log_path) > self.max_log_bytes:
+                # Workers see the new inode and drop their whole cache
+                tmp_path = f'{self.log_path}.{os.getpid()}.tmp'
+                open(tmp_path, 'wb').close()
+                os.replace(tmp_path, self.log_path)
+        except OSError:
+            pass
+        try:
+            # A single O_APPEND write keeps lines from different workers whole
+            fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, f'{line}\n'.encode())
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f"Product invalidation log write failed: {e}")
+    
+    def get_many(self, product_ids, fields=None):
+        """Return ({product_id: product JSON or None} for cached IDs, [missing IDs])"""
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            self._sync()
+            for product_id in product_ids:
+                entry = self._entries.get((fields, product_id))
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end((fields, product_id))
+                    found[product_id] = entry[1]
+                else:
+                    missing.append(product_id)
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+    
+    def put_many(self, rows, fields=None):
+        """Cache {product_id: product JSON or None}"""
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for product_id, row in rows.items():
+                self._entries[(fields, product_id)] = (expires_at, row)
+                self._entries.move_to_end((fields, product_id))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, product_ids=None):
+        """Drop the given products, or everything if product_ids is None, in every worker.
+        
+        Returns the number of entries dropped from this worker's cache.
+        """
+        if product_ids is not None:
+            product_ids = sorted(set(product_ids))
+            if not product_ids:
+                return 0
+        with self._lock:
+            self._sync()
+            self._log(product_ids)
+            return self._drop(product_ids)
+    
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+class MemoryResultCache:
+    """In-process LRU of ranked product-ID lists, tagged with a model version"""
+    
+    def __init__(self, max_size=RESULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, version):
+        with self._lock:
+            if version != self._version:
+                # A retrain happened: everything cached is stale
+                self._entries.clear()
+                self._version = version
+            product_ids = self._entries.get(key)
+            if product_ids is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(product_ids)
+    
+    def set(self, key, version, product_ids):
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            self._entries[key] = tuple(product_ids)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': 'memory',
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+class FileResultCache:
+    """Ranked product-ID lists in a memory-mapped SQLite file shared by all workers.
+    
+    Rows from other model versions are ignored on read and purged on the first
+    write under a new version.
+    """
+    
+    def __init__(self, path=RESULT_CACHE_PATH, max_size=RESULT_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._local = threading.local()
+        self._inherited = []
+        self._purged_version = None
+        self.hits = 0
+        self.misses = 0
+        self._connect().execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                cache_key TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                product_ids BLOB NOT NULL,
+                stored_at REAL NOT NULL
+            )
         """)
-        searches = cursor.fetchall()
+        if hasattr(os, 'register_at_fork'):
+            # SQLite connections must not be used across fork (preload_app
+            # creates this cache in the gunicorn master)
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+    
+    def _reset_after_fork(self):
+        # The master's connection is kept referenced but never used: closing
+        # it here would release the POSIX locks of the worker's own connections
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._inherited.append(conn)
+        self._local = threading.local()
+    
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('PRAGMA mmap_size=268435456')
+            self._local.conn = conn
+        return conn
+    
+    @staticmethod
+    def _key(key):
+        return ':'.join(str(part) for part in key)
+    
+    def get(self, key, version):
+        try:
+            row = self._connect().execute(
+                'SELECT product_ids FROM results WHERE cache_key = ? AND version = ?',
+                (self._key(key), version)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Result cache read failed: {e}")
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.frombuffer(row[0], dtype=np.int64).tolist()
+    
+    def set(self, key, version, product_ids):
+        try:
+            conn = self._connect()
+            if self._purged_version != version:
+                conn.execute('DELETE FROM results WHERE version != ?', (version,))
+                self._purged_version = version
+            conn.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                (self._key(key), version, np.asarray(product_ids, dtype=np.int64).tobytes(), time.time())
+            )
+            if self.hits + self.misses and (self.hits + self.misses) % 1000 == 0:
+                # Occasionally trim the oldest entries beyond max_size
+                conn.execute("""
+                    DELETE FROM results WHERE cache_key IN (
+                        SELECT cache_key FROM results ORDER BY stored_at DESC LIMIT -1 OFFSET ?
+                    )
+                """, (self.max_size,))
+        except sqlite3.Error as e:
+            print(f"Result cache write failed: {e}")
+    
+    def clear(self):
+        self._connect().execute('DELETE FROM results')
+    
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': 'file',
+            'path': self.path,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+def create_result_cache(backend=RESULT_CACHE_BACKEND):
+    """Result cache for the configured backend (None disables caching)"""
+    if backend == 'file':
+        return FileResultCache()
+    if backend == 'memory':
+        return MemoryResultCache()
+    return None
+
+class PrecomputedStore:
+    """Memory-mapped table of precomputed top-N recommendations.
+    
+    Each published run is one .npy array of shape (customers, 1 + top_n):
+    column 0 is the customer ID (sorted), the rest are product IDs padded
+    with -1. manifest.json names the current file and the model version it
+    was computed from, and is replaced atomically on publish.
+    """
+    
+    def __init__(self, directory=PRECOMPUTED_DIR, check_interval=PRECOMPUTED_CHECK_INTERVAL):
+        self.directory = directory
+        self.check_interval = check_interval
+        self.manifest = None
+        self.table = None
+        self._manifest_mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+    
+    @property
+    def manifest_path(self):
+        return os.path.join(self.directory, 'manifest.json')
+    
+    def refresh(self, force=False):
+        """Re-open the table if manifest.json changed (checked at most every check_interval)"""
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.manifest_path).st_mtime_ns
+            except OSError:
+                self.manifest, self.table, self._manifest_mtime = None, None, None
+                return
+            if mtime == self._manifest_mtime:
+                return
+            try:
+                with open(self.manifest_path) as f:
+                    manifest = json.load(f)
+                table = np.load(os.path.join(self.directory, manifest['file']), mmap_mode='r')
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error loading precomputed recommendations: {e}")
+                return
+            self.manifest, self.table, self._manifest_mtime = manifest, table, mtime
+    
+    def lookup(self, customer_id, n_recommendations, model_version, retrieval):
+        """Precomputed product IDs, or None if not covered or not fresh.
+        
+        Only requests for exactly the stored top_n are served: hybrid scores
+        depend on the list depth, so a prefix of a longer list is not the
+        shorter hybrid list.
+        """
+        self.refresh()
+        manifest, table = self.manifest, self.table
+        if (table is None or manifest.get('model_version') != model_version
+                or manifest.get('retrieval') != retrieval or n_recommendations != manifest.get('top_n')):
+            return None
+        
+        customer_ids = table[:, 0]
+        pos = np.searchsorted(customer_ids, customer_id)
+        if pos >= len(customer_ids) or customer_ids[pos] != customer_id:
+            return None
+        row = table[pos, 1:]
+        return row[row >= 0].tolist()
+    
+    def publish(self, recommendations, model_version, top_n, retrieval, method='hybrid'):
+        """Atomically write {customer_id: [product_id, ...]} as the current table"""
+        os.makedirs(self.directory, exist_ok=True)
+        customer_ids = sorted(recommendations)
+        table = np.full((len(customer_ids), 1 + top_n), -1, dtype=np.int64)
+        for row, customer_id in enumerate(customer_ids):
+            product_ids = recommendations[customer_id][:top_n]
+            table[row, 0] = customer_id
+            table[row, 1:1 + len(product_ids)] = product_ids
+        
+        stamp = datetime.now().strftime('%Y%m%d%H%M%S%f')
+        filename = f'{method}_top{top_n}_{stamp}.npy'
+        np.save(os.path.join(self.directory, filename), table)
         
-        cursor.close()
+        manifest = {
+            'file': filename,
+            'model_version': model_version,
+            'method': method,
+            'retrieval': retrieval,
+            'top_n': top_n,
+            'customers': len(customer_ids),
+            'created_at': datetime.now().isoformat(),
+        }
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+        
+        # Older tables are no longer referenced
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy') and name != filename:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
         
-        return interactions, products, searches
+        self.refresh(force=True)
+        return manifest
+
+class ModelSnapshot:
+    """One consistent generation of trained model state.
+    
+    A snapshot is built completely (by training, fold-in or loading) before it
+    is published with a single reference assignment, and is not mutated after
+    that, so a request that grabs `service.model` once sees consistent state.
+    """
+    
+    def __init__(self):
+        self.svd_model = None
+        self.item_factors = None  # ALS product factors (CF_TRAINER=als), used to fold in users
+        self.tfidf_vectorizer = None
+        self.product_vectors = None
+        self.content_product_ids = np.empty(0, dtype=np.int64)
+        self.content_sorter = np.empty(0, dtype=np.int64)
+        # Category and purchase count per content row, and the rows of each
+        # category by popularity (candidate source of two-stage retrieval)
+        self.content_categories = None
+        self.content_popularity = None
+        self.category_ids = None
+        self.category_indptr = None
+        self.category_rows = None
+        self.neighbor_idx = None
+        self.neighbor_scores = None
+        self.user_item_matrix = None
+        self.user_factors = None
+        self.user_index = None
+        self.user_to_idx = {}
+        self.product_to_idx = {}
+        self.idx_to_user = np.empty(0, dtype=np.int64)
+        self.idx_to_product = np.empty(0, dtype=np.int64)
+        self.product_sorter = np.empty(0, dtype=np.int64)
+        self.model_trained_at = None
+        self.model_full_trained_at = None
+        self.artifact_directory = None  # artifact version this model was saved as / loaded from
+        # Products each customer ordered or viewed, CSR-style, and the mean
+        # TF-IDF profile of each history (None: not indexed, query the DB)
+        self.history_customers = None
+        self.history_indptr = None
+        self.history_products = None
+        self.history_profiles = None
+        # Inverted index over TF-IDF terms: product rows of term t are
+        # term_rows[term_indptr[t]:term_indptr[t + 1]], highest weight first
+        self.term_indptr = None
+        self.term_rows = None
+        self.term_weights = None
+        # Search-count weighted TF-IDF vector of each customer's recent searches
+        self.search_customers = None
+        self.search_profiles = None
+        # Cold-start tables: product IDs by overall and trending-window popularity
+        self.popular_products = None
+        self.trending_products = None
+    
+    @property
+    def has_collaborative(self):
+        """True if a collaborative filtering model (SVD or ALS) is trained"""
+        return self.svd_model is not None or self.item_factors is not None
+    
+    @property
+    def model_version(self):
+        """Identifier of the trained model generation (None if untrained)"""
+        return self.model_trained_at.isoformat() if self.model_trained_at else None
     
     def build_user_item_matrix(self, interactions):
-        """Build user-item interaction matrix"""
-        if not interactions:
+        """Build sparse (CSR) user-item interaction matrix from column arrays"""
+        if not row_count(interactions):
             return None, {}, {}
         
-        # Get unique users and products
-        users = sorted(set([i['customer_id'] for i in interactions]))
-        products = sorted(set([i['product_id'] for i in interactions]))
+        # Unique (sorted) users and products, and each row's position in them
+        users, rows = np.unique(interactions['customer_id'], return_inverse=True)
+        products, cols = np.unique(interactions['product_id'], return_inverse=True)
         
-        user_to_idx = {user: idx for idx, user in enumerate(users)}
-        product_to_idx = {product: idx for idx, product in enumerate(products)}
+        user_to_idx = dict(zip(users.tolist(), range(len(users))))
+        product_to_idx = dict(zip(products.tolist(), range(len(products))))
         
-        # Build matrix (users x products)
-        matrix = np.zeros((len(users), len(products)))
+        # Weight: quantity + order count
+        scores = interactions['total_quantity'] + interactions['order_count'] * 2
         
-        for interaction in interactions:
-            user_idx = user_to_idx[interaction['customer_id']]
-            product_idx = product_to_idx[interaction['product_id']]
-            # Weight: quantity + order count
-            score = interaction['total_quantity'] + (interaction['order_count'] * 2)
-            matrix[user_idx, product_idx] = score
+        # Build matrix (users x products) from coordinate arrays so memory
+        # grows with the number of interactions, not users x products
+        matrix = sparse.csr_matrix(
+            (scores.astype(np.float32), (rows, cols)), shape=(len(users), len(products)), dtype=np.float32
+        )
+        matrix.sum_duplicates()
         
         return matrix, user_to_idx, product_to_idx
     
-    def train_collaborative_filtering(self, interactions):
-        """Train SVD model for collaborative filtering"""
+    def train_collaborative_filtering(self, interactions, trainer=CF_TRAINER, progress=None):
+        """Train the collaborative filtering model ('svd' or 'als')"""
         try:
             matrix, user_to_idx, product_to_idx = self.build_user_item_matrix(interactions)
             
-            if matrix is None or matrix.size == 0:
+            if matrix is None or matrix.nnz == 0:
                 return False
             
-            # Use TruncatedSVD for dimensionality reduction
-            n_components = min(50, min(matrix.shape) - 1)  # Number of latent factors
+            n_components = min(CF_FACTORS, min(matrix.shape) - 1)  # Number of latent factors
             if n_components < 1:
                 return False
             
-            self.svd_model = TruncatedSVD(n_components=n_components, random_state=42)
             self.user_item_matrix = matrix
             self.user_to_idx = user_to_idx
             self.product_to_idx = product_to_idx
+            self.index_ids()
             
-            # Fit the model
-            self.svd_model.fit(matrix)
+            started = time.perf_counter()
+            if trainer == 'als':
+                def report(fraction):
+                    print(f"  ALS iteration {round(fraction * ALS_ITERATIONS)}/{ALS_ITERATIONS} "
+                          f"({time.perf_counter() - started:.1f}s)")
+                    if progress:
+                        progress(fraction)
+                
+                user_latent, self.item_factors = train_als(matrix, n_components, progress=report)
+            else:
+                # Fit the model and project every user into the latent space once,
+                # so the request path only needs a matrix-vector product
+                self.svd_model = TruncatedSVD(n_components=n_components, random_state=42)
+                user_latent = self.svd_model.fit_transform(matrix)
+            self.user_factors = normalize(user_latent).astype(np.float32)
+            print(f"Collaborative filtering ({trainer}) trained in {time.perf_counter() - started:.1f}s")
             
             return True
         except Exception as e:
@@ -192,88 +1390,1442 @@ class RecommendationService:
             # Initialize empty attributes if training fails
             self.user_to_idx = {}
             self.product_to_idx = {}
+            self.index_ids()
             return False
     
+    def index_ids(self):
+        """Rebuild the array-backed inverse maps for user_to_idx/product_to_idx"""
+        self.idx_to_user, _ = build_id_index(self.user_to_idx)
+        self.idx_to_product, self.product_sorter = build_id_index(self.product_to_idx)
+    
+    def product_indices(self, product_ids):
+        """Map product IDs to user-item matrix columns (-1 if unknown)"""
+        return lookup_indices(self.idx_to_product, self.product_sorter, product_ids)
+    
     def train_content_based(self, products):
         """Train TF-IDF model for content-based recommendations"""
-        if not products:
+        if not row_count(products):
             return False
         
-        # Combine product name and description
-        product_texts = []
-        for product in products:
-            text = f"{product['name']} {product.get('description', '')} {product.get('category_name', '')}"
-            product_texts.append(text)
-        
         # Create TF-IDF vectors
         self.tfidf_vectorizer = TfidfVectorizer(max_features=100, stop_words='english')
-        product_vectors = self.tfidf_vectorizer.fit_transform(product_texts)
+        product_vectors = self.tfidf_vectorizer.fit_transform(product_texts(products))
         
-        # Store product features
-        self.product_features = {
-            products[i]['product_id']: product_vectors[i] 
-            for i in range(len(products))
-        }
+        # Store product features as one L2-normalized CSR matrix whose rows
+        # line up with content_product_ids
+        self.product_vectors = normalize(product_vectors).astype(np.float32).tocsr()
+        self.content_product_ids = np.asarray(products['product_id'], dtype=np.int64)
+        self.content_sorter = np.argsort(self.content_product_ids, kind='stable')
+        self.content_categories = np.asarray(products['category_id'], dtype=np.int64)
+        self.content_popularity = np.asarray(products['purchase_count'], dtype=np.float32)
+        self.category_ids, self.category_indptr, self.category_rows = build_category_index(
+            self.content_categories, self.content_popularity
+        )
+        
+        # Precompute the item-to-item neighbor table served by /similar
+        self.neighbor_idx, self.neighbor_scores = build_neighbor_table(
+            self.product_vectors, SIMILAR_NEIGHBORS
+        )
         
         return True
     
-    def train_models(self):
-        """Train all recommendation models"""
-        print("Loading training data...")
-        interactions, products, searches = self.load_training_data()
+    def build_popularity(self, products, popularity, size=COLD_START_SIZE):
+        """Rank content rows by popularity for two-stage candidates and cold start"""
+        rows = self.content_indices(popularity['product_id'])
+        known = rows >= 0
+        events = np.zeros(len(self.content_product_ids), dtype=np.float32)
+        trending = np.zeros(len(self.content_product_ids), dtype=np.float32)
+        events[rows[known]] = popularity['popularity'][known]
+        trending[rows[known]] = popularity['trending'][known]
+        
+        # Unrated products count as average (3 stars)
+        ratings = np.asarray(products['avg_rating'], dtype=np.float32)
+        boost = np.where(ratings > 0, ratings, 3.0) / 3.0
+        self.content_popularity = events * boost
+        self.category_ids, self.category_indptr, self.category_rows = build_category_index(
+            self.content_categories, self.content_popularity
+        )
+        
+        self.popular_products = self.content_product_ids[np.argsort(-self.content_popularity, kind='stable')[:size]]
+        trending_scores = trending * boost
+        top = top_k(trending_scores, size)
+        self.trending_products = self.content_product_ids[top[trending_scores[top] > 0]]
+    
+    def content_indices(self, product_ids):
+        """Map product IDs to TF-IDF matrix rows (-1 if unknown)"""
+        return lookup_indices(self.content_product_ids, self.content_sorter, product_ids)
+    
+    def build_user_index(self):
+        """Build the approximate similar-user index if USER_INDEX selects it"""
+        self.user_index = None
+        if self.user_factors is not None and USER_INDEX == 'ivf':
+            self.user_index = IVFIndex.build(self.user_factors, USER_INDEX_LISTS)
+    
+    def content_profiles(self, indptr, product_ids):
+        """Mean TF-IDF vector of each product list given CSR-style as (indptr, product IDs)"""
+        rows = self.content_indices(product_ids)
+        counts = np.diff(indptr)
+        owner = np.repeat(np.arange(len(counts)), counts)
+        valid = rows >= 0
+        owner, rows = owner[valid], rows[valid]
+        
+        lengths = np.bincount(owner, minlength=len(counts))
+        weights = (1.0 / np.maximum(lengths, 1))[owner].astype(np.float32)
+        averaging = sparse.csr_matrix((weights, (owner, rows)), shape=(len(counts), self.product_vectors.shape[0]))
+        return (averaging @ self.product_vectors).tocsr()
+    
+    def build_history(self, customer_ids, product_ids):
+        """Index each customer's ordered/viewed products and precompute their content profiles"""
+        self.history_customers, self.history_indptr, self.history_products = build_history_index(
+            customer_ids, product_ids
+        )
+        self.history_profiles = None
+        if self.product_vectors is not None:
+            self.history_profiles = self.content_profiles(self.history_indptr, self.history_products)
+    
+    def build_term_index(self):
+        """Invert product_vectors into per-term postings lists sorted by weight"""
+        postings = self.product_vectors.T.tocsr()
+        terms = np.repeat(np.arange(postings.shape[0]), np.diff(postings.indptr))
+        order = np.lexsort((-postings.data, terms))
+        self.term_indptr = postings.indptr.astype(np.int64)
+        self.term_rows = postings.indices[order].astype(np.int64)
+        self.term_weights = postings.data[order].astype(np.float32)
+    
+    def search_vectors(self, searches):
+        """(sorted customer IDs, customers x terms CSR) summing count-weighted search vectors"""
+        customer_ids = np.asarray(searches['customer_id'], dtype=np.int64)
+        valid = np.flatnonzero(customer_ids >= 0)
+        if not len(valid):
+            n_terms = len(self.tfidf_vectorizer.vocabulary_)
+            return np.empty(0, dtype=np.int64), sparse.csr_matrix((0, n_terms), dtype=np.float32)
+        vectors = self.tfidf_vectorizer.transform(
+            [searches['search_term'][i] or '' for i in valid]
+        ).astype(np.float32)
+        customers, inverse = np.unique(customer_ids[valid], return_inverse=True)
+        summing = sparse.csr_matrix(
+            (np.asarray(searches['search_count'], dtype=np.float32)[valid], (inverse, np.arange(len(valid)))),
+            shape=(len(customers), len(valid))
+        )
+        return customers, (summing @ vectors).tocsr()
+    
+    def build_search_profiles(self, searches):
+        """Per-customer search-term vectors from the user_searches rows"""
+        self.search_customers, self.search_profiles = self.search_vectors(searches)
+    
+    def fold_in_searches(self, searches):
+        """Add new searches to the search profiles; returns the new state without touching self"""
+        if self.search_customers is None or self.tfidf_vectorizer is None:
+            return None
+        customers, vectors = self.search_vectors(searches)
+        
+        # Sum old and new rows of the same customer with one sparse product
+        all_customers = np.concatenate([self.search_customers, customers])
+        merged, inverse = np.unique(all_customers, return_inverse=True)
+        summing = sparse.csr_matrix(
+            (np.ones(len(all_customers), dtype=np.float32), (inverse, np.arange(len(all_customers)))),
+            shape=(len(merged), len(all_customers))
+        )
+        profiles = summing @ sparse.vstack([self.search_profiles, vectors]).tocsr()
+        return {'search_customers': merged, 'search_profiles': profiles.tocsr()}
+    
+    def fold_in_interactions(self, interactions):
+        """Fold new/changed customers into the existing latent space.
+        
+        Their matrix rows are replaced with the fresh history and projected
+        with the stored SVD components (or solved against the ALS product
+        factors); products unseen at fit time get new matrix columns (they
+        can be recommended, but do not shape the projection until the next
+        full retrain). Returns the updated state without touching self.
+        """
+        if self.item_factors is not None:
+            components = self.item_factors.T
+        else:
+            components = self.svd_model.components_
+        n_fit_products = components.shape[1]
+        
+        customer_ids = interactions['customer_id']
+        product_ids = interactions['product_id']
+        
+        user_to_idx = dict(self.user_to_idx)
+        product_to_idx = dict(self.product_to_idx)
+        for customer_id in np.unique(customer_ids).tolist():
+            user_to_idx.setdefault(customer_id, len(user_to_idx))
+        for product_id in np.unique(product_ids).tolist():
+            product_to_idx.setdefault(product_id, len(product_to_idx))
+        
+        idx_to_user, user_sorter = build_id_index(user_to_idx)
+        idx_to_product, product_sorter = build_id_index(product_to_idx)
+        rows = lookup_indices(idx_to_user, user_sorter, customer_ids)
+        cols = lookup_indices(idx_to_product, product_sorter, product_ids)
+        scores = (interactions['total_quantity'] + interactions['order_count'] * 2).astype(np.float32)
+        changed_rows = np.unique(rows)
+        
+        # Keep the old entries of unchanged users, replace the changed ones
+        old = self.user_item_matrix.tocoo()
+        keep = ~np.isin(old.row, changed_rows)
+        shape = (len(user_to_idx), len(product_to_idx))
+        matrix = sparse.csr_matrix(
+            (np.concatenate([old.data[keep], scores]),
+             (np.concatenate([old.row[keep], rows]), np.concatenate([old.col[keep], cols]))),
+            shape=shape, dtype=np.float32
+        )
+        matrix.sum_duplicates()
+        
+        user_factors = np.zeros((shape[0], components.shape[0]), dtype=np.float32)
+        user_factors[:len(self.user_factors)] = self.user_factors
+        changed = matrix[changed_rows][:, :n_fit_products]
+        if self.item_factors is not None:
+            changed_latent = np.zeros((len(changed_rows), components.shape[0]), dtype=np.float32)
+            als_solve(als_confidence(changed), self.item_factors, changed_latent)
+        else:
+            changed_latent = changed @ components.T
+        user_factors[changed_rows] = normalize(changed_latent)
+        
+        return {
+            'user_item_matrix': matrix,
+            'user_factors': user_factors,
+            'user_to_idx': user_to_idx,
+            'product_to_idx': product_to_idx,
+        }
+    
+    def fold_in_products(self, products):
+        """Vectorize new products with the fitted TF-IDF vocabulary.
+        
+        Returns the updated content state without touching self. New products
+        get neighbor rows; existing rows pick them up at the next full retrain.
+        """
+        is_new = self.content_indices(products['product_id']) < 0
+        if not is_new.any():
+            return None
+        
+        texts = [text for text, new in zip(product_texts(products), is_new) if new]
+        new_vectors = normalize(self.tfidf_vectorizer.transform(texts)).astype(np.float32)
+        product_vectors = sparse.vstack([self.product_vectors, new_vectors]).tocsr()
+        content_product_ids = np.concatenate([
+            self.content_product_ids, np.asarray(products['product_id'], dtype=np.int64)[is_new]
+        ])
+        
+        new_idx, new_scores = build_neighbor_table(
+            product_vectors, SIMILAR_NEIGHBORS, start_row=self.product_vectors.shape[0]
+        )
+        k = new_idx.shape[1]
+        if self.neighbor_idx is not None and self.neighbor_idx.shape[1] == k:
+            neighbor_idx = np.vstack([self.neighbor_idx, new_idx])
+            neighbor_scores = np.vstack([self.neighbor_scores, new_scores])
+        else:
+            neighbor_idx, neighbor_scores = build_neighbor_table(product_vectors, SIMILAR_NEIGHBORS)
+        
+        state = {
+            'product_vectors': product_vectors,
+            'content_product_ids': content_product_ids,
+            'content_sorter': np.argsort(content_product_ids, kind='stable'),
+            'neighbor_idx': neighbor_idx,
+            'neighbor_scores': neighbor_scores,
+        }
+        if self.content_categories is not None:
+            # New products have no purchases yet, so they rank last in their category
+            state['content_categories'] = np.concatenate([
+                self.content_categories, np.asarray(products['category_id'], dtype=np.int64)[is_new]
+            ])
+            state['content_popularity'] = np.concatenate([
+                self.content_popularity, np.zeros(int(is_new.sum()), dtype=np.float32)
+            ])
+            state['category_ids'], state['category_indptr'], state['category_rows'] = build_category_index(
+                state['content_categories'], state['content_popularity']
+            )
+        return state
+    
+    def fold_in_history(self, history):
+        """Merge new (customer, product) pairs into the history index.
+        
+        Returns the updated history state without touching self; only the
+        profiles of customers with new pairs are recomputed.
+        """
+        if self.history_customers is None:
+            return None
+        
+        old_counts = np.diff(self.history_indptr)
+        customers, indptr, products = build_history_index(
+            np.concatenate([np.repeat(self.history_customers, old_counts), history['customer_id']]),
+            np.concatenate([self.history_products, history['product_id']])
+        )
+        state = {'history_customers': customers, 'history_indptr': indptr, 'history_products': products}
+        if self.product_vectors is None:
+            state['history_profiles'] = None
+            return state
+        
+        is_changed = np.isin(customers, np.asarray(history['customer_id'], dtype=np.int64))
+        changed = np.flatnonzero(is_changed)
+        changed_counts = np.diff(indptr)[changed]
+        changed_products = np.concatenate(
+            [products[indptr[i]:indptr[i + 1]] for i in changed]
+        ) if len(changed) else np.empty(0, dtype=np.int64)
+        changed_profiles = self.content_profiles(
+            np.concatenate([[0], np.cumsum(changed_counts)]), changed_products
+        )
+        
+        # Unchanged customers keep their old profile row; changed ones (in
+        # sorted order, like `customers`) come after the old rows
+        n_old = len(self.history_customers)
+        take = np.empty(len(customers), dtype=np.int64)
+        take[~is_changed] = np.searchsorted(self.history_customers, customers[~is_changed])
+        take[is_changed] = n_old + np.arange(len(changed))
+        profiles = self.history_profiles
+        if profiles is None:
+            profiles = self.content_profiles(self.history_indptr, self.history_products)
+        state['history_profiles'] = sparse.vstack([profiles, changed_profiles]).tocsr()[take]
+        return state
+    
+    def folded_in(self, interactions, products, history, searches, trained_at):
+        """New snapshot with interactions, products, history and searches folded into this one"""
+        cf_state = self.fold_in_interactions(interactions) if row_count(interactions) else None
+        cb_state = self.fold_in_products(products) if row_count(products) else None
+        
+        model = copy.copy(self)
+        if cf_state:
+            for name, value in cf_state.items():
+                setattr(model, name, value)
+            model.index_ids()
+            if USER_INDEX == 'ivf':
+                if self.user_index is not None:
+                    model.user_index = IVFIndex.from_centroids(self.user_index.centroids, model.user_factors)
+                else:
+                    model.build_user_index()
+        if cb_state:
+            for name, value in cb_state.items():
+                setattr(model, name, value)
+            if model.term_indptr is not None:
+                model.build_term_index()
+        search_state = model.fold_in_searches(searches) if row_count(searches) else None
+        if search_state:
+            for name, value in search_state.items():
+                setattr(model, name, value)
+        # After the products, so profiles can use newly vectorized ones
+        history_state = model.fold_in_history(history) if row_count(history) else None
+        if history_state:
+            for name, value in history_state.items():
+                setattr(model, name, value)
+        model.model_trained_at = trained_at
+        return model
+    
+    def save(self):
+        """Save the model to disk as a memory-mappable artifact"""
+        arrays = {}
+        meta = {
+            'trained_at': self.model_trained_at.isoformat() if self.model_trained_at else None,
+            'full_trained_at': self.model_full_trained_at.isoformat() if self.model_full_trained_at else None,
+        }
+        
+        for name in ('user_item_matrix', 'product_vectors', 'history_profiles', 'search_profiles'):
+            matrix = getattr(self, name)
+            if matrix is not None:
+                arrays[f'{name}_data'] = matrix.data
+                arrays[f'{name}_indices'] = matrix.indices
+                arrays[f'{name}_indptr'] = matrix.indptr
+                meta[f'{name}_shape'] = list(matrix.shape)
+        
+        if self.svd_model is not None:
+            arrays['svd_components'] = self.svd_model.components_.astype(np.float32)
+        if self.item_factors is not None:
+            arrays['als_item_factors'] = self.item_factors
+        if self.user_factors is not None:
+            arrays['user_factors'] = self.user_factors
+            arrays['idx_to_user'] = self.idx_to_user
+            arrays['user_sorter'] = np.argsort(self.idx_to_user, kind='stable')
+            arrays['idx_to_product'] = self.idx_to_product
+            arrays['product_sorter'] = self.product_sorter
+        if self.user_index is not None:
+            arrays['user_index_centroids'] = self.user_index.centroids
+            arrays['user_index_offsets'] = self.user_index.list_offsets
+            arrays['user_index_members'] = self.user_index.list_members
+        if self.product_vectors is not None:
+            arrays['content_product_ids'] = self.content_product_ids
+            arrays['content_sorter'] = self.content_sorter
+        if self.category_ids is not None:
+            for name in ('content_categories', 'content_popularity', 'category_ids', 'category_indptr', 'category_rows'):
+                arrays[name] = getattr(self, name)
+        if self.neighbor_idx is not None:
+            arrays['neighbor_idx'] = self.neighbor_idx
+            arrays['neighbor_scores'] = self.neighbor_scores
+        if self.term_indptr is not None:
+            arrays['term_indptr'] = self.term_indptr
+            arrays['term_rows'] = self.term_rows
+            arrays['term_weights'] = self.term_weights
+        if self.search_customers is not None:
+            arrays['search_customers'] = self.search_customers
+        if self.popular_products is not None:
+            arrays['popular_products'] = self.popular_products
+            arrays['trending_products'] = self.trending_products
+        if self.history_customers is not None:
+            arrays['history_customers'] = self.history_customers
+            arrays['history_indptr'] = self.history_indptr
+            arrays['history_products'] = self.history_products
+        
+        objects = {}
+        if self.tfidf_vectorizer is not None:
+            objects['tfidf_vectorizer'] = self.tfidf_vectorizer
+        
+        manifest = write_artifact(arrays, meta, objects)
+        self.artifact_directory = manifest['directory']
+        return manifest
+    
+    def load_artifact(self):
+        """Memory-map the current model artifact (shared page cache across workers)"""
+        manifest, arrays, objects = read_artifact()
+        
+        def csr(name):
+            if f'{name}_data' not in arrays:
+                return None
+            return sparse.csr_matrix(
+                (arrays[f'{name}_data'], arrays[f'{name}_indices'], arrays[f'{name}_indptr']),
+                shape=tuple(manifest[f'{name}_shape']), copy=False
+            )
+        
+        self.user_item_matrix = csr('user_item_matrix')
+        self.product_vectors = csr('product_vectors')
+        self.history_profiles = csr('history_profiles')
+        self.search_profiles = csr('search_profiles')
+        self.search_customers = arrays.get('search_customers')
+        self.popular_products = arrays.get('popular_products')
+        self.trending_products = arrays.get('trending_products')
+        self.term_indptr = arrays.get('term_indptr')
+        self.term_rows = arrays.get('term_rows')
+        self.term_weights = arrays.get('term_weights')
+        self.history_customers = arrays.get('history_customers')
+        self.history_indptr = arrays.get('history_indptr')
+        self.history_products = arrays.get('history_products')
+        
+        self.svd_model = None
+        if 'svd_components' in arrays:
+            components = arrays['svd_components']
+            self.svd_model = TruncatedSVD(n_components=components.shape[0])
+            self.svd_model.components_ = components
+            self.svd_model.n_features_in_ = components.shape[1]
+        self.item_factors = arrays.get('als_item_factors')
+        self.tfidf_vectorizer = objects.get('tfidf_vectorizer')
+        
+        self.user_factors = arrays.get('user_factors')
+        if self.user_factors is not None:
+            self.idx_to_user = arrays['idx_to_user']
+            self.idx_to_product = arrays['idx_to_product']
+            self.product_sorter = arrays['product_sorter']
+            self.user_to_idx = IdMap(self.idx_to_user, arrays['user_sorter'])
+            self.product_to_idx = IdMap(self.idx_to_product, self.product_sorter)
+        else:
+            self.user_to_idx = {}
+            self.product_to_idx = {}
+            self.index_ids()
+        
+        self.user_index = None
+        if 'user_index_centroids' in arrays:
+            self.user_index = IVFIndex(
+                arrays['user_index_centroids'], arrays['user_index_offsets'], arrays['user_index_members']
+            )
+        elif USER_INDEX == 'ivf' and self.user_factors is not None:
+            self.user_index = IVFIndex.build(self.user_factors, USER_INDEX_LISTS)
+        
+        self.content_product_ids = arrays.get('content_product_ids', np.empty(0, dtype=np.int64))
+        self.content_sorter = arrays.get('content_sorter', np.empty(0, dtype=np.int64))
+        for name in ('content_categories', 'content_popularity', 'category_ids', 'category_indptr', 'category_rows'):
+            setattr(self, name, arrays.get(name))
+        self.neighbor_idx = arrays.get('neighbor_idx')
+        self.neighbor_scores = arrays.get('neighbor_scores')
+        
+        self.model_trained_at = datetime.fromisoformat(manifest['trained_at']) if manifest.get('trained_at') else None
+        full_trained_at = manifest.get('full_trained_at') or manifest.get('trained_at')
+        self.model_full_trained_at = datetime.fromisoformat(full_trained_at) if full_trained_at else None
+        self.artifact_directory = manifest['directory']
+    
+    def load_legacy_pickle(self, path=LEGACY_MODEL_PATH):
+        """Load models saved by older versions as a single pickle"""
+        with open(path, 'rb') as f:
+            models = pickle.load(f)
         
-        if not interactions and not products:
-            print("No data available for training")
+        self.svd_model = models.get('svd_model')
+        self.tfidf_vectorizer = models.get('tfidf_vectorizer')
+        self.product_vectors = models.get('product_vectors')
+        self.content_product_ids = models.get('content_product_ids', np.empty(0, dtype=np.int64))
+        if self.product_vectors is None and models.get('product_features'):
+            # Older pickles stored one 1-row sparse vector per product
+            features = models['product_features']
+            self.content_product_ids = np.array(list(features.keys()), dtype=np.int64)
+            self.product_vectors = normalize(sparse.vstack(list(features.values()))).astype(np.float32).tocsr()
+        self.content_sorter = np.argsort(self.content_product_ids, kind='stable')
+        self.neighbor_idx = models.get('neighbor_idx')
+        self.neighbor_scores = models.get('neighbor_scores')
+        if self.neighbor_idx is None and self.product_vectors is not None:
+            self.neighbor_idx, self.neighbor_scores = build_neighbor_table(
+                self.product_vectors, SIMILAR_NEIGHBORS
+            )
+        self.user_item_matrix = models.get('user_item_matrix')
+        if self.user_item_matrix is not None and not sparse.issparse(self.user_item_matrix):
+            # Older pickles stored a dense ndarray
+            self.user_item_matrix = sparse.csr_matrix(self.user_item_matrix, dtype=np.float32)
+        self.user_factors = models.get('user_factors')
+        if self.user_factors is None and self.svd_model is not None and self.user_item_matrix is not None:
+            # Older pickles did not store the projected users
+            self.user_factors = normalize(self.svd_model.transform(self.user_item_matrix)).astype(np.float32)
+        self.user_index = models.get('user_index')
+        if self.user_index is None and USER_INDEX == 'ivf' and self.user_factors is not None:
+            self.user_index = IVFIndex.build(self.user_factors, USER_INDEX_LISTS)
+        self.user_to_idx = models.get('user_to_idx', {})
+        self.product_to_idx = models.get('product_to_idx', {})
+        self.index_ids()
+        
+        if models.get('trained_at'):
+            self.model_trained_at = datetime.fromisoformat(models['trained_at'])
+        full_trained_at = models.get('full_trained_at') or models.get('trained_at')
+        if full_trained_at:
+            self.model_full_trained_at = datetime.fromisoformat(full_trained_at)
+    
+    def find_similar_users(self, user_idx, n_users=10):
+        """Most similar users to user_idx as (user rows, cosine similarities)"""
+        query = self.user_factors[user_idx]
+        
+        if USER_INDEX == 'ivf' and self.user_index is not None:
+            return self.user_index.search(self.user_factors, query, n_users, exclude=user_idx)
+        
+        # Exact: cosine similarity against every user is a single mat-vec on
+        # the precomputed, L2-normalized latent factors
+        similarities = self.user_factors @ query
+        similarities[user_idx] = -np.inf
+        similar_users_idx = top_k(similarities, min(n_users, len(similarities) - 1))
+        return similar_users_idx, similarities[similar_users_idx]
+    
+    def find_similar_users_batch(self, user_rows, n_users=10):
+        """Most similar users of each of user_rows as ([user rows], [cosine similarities]).
+        
+        Exact search is one factors matrix-matrix product for the whole batch.
+        """
+        n_users = min(n_users, self.user_factors.shape[0] - 1)
+        if n_users < 1:
+            return ([np.empty(0, dtype=np.int64)] * len(user_rows),
+                    [np.empty(0, dtype=np.float32)] * len(user_rows))
+        if USER_INDEX == 'ivf' and self.user_index is not None:
+            neighbors = [self.find_similar_users(user_idx, n_users) for user_idx in user_rows]
+            return [idx for idx, _ in neighbors], [sims for _, sims in neighbors]
+        
+        similarities = self.user_factors[user_rows] @ self.user_factors.T
+        similarities[np.arange(len(user_rows)), user_rows] = -np.inf
+        top = np.argpartition(-similarities, n_users - 1, axis=1)[:, :n_users]
+        return list(top), list(np.take_along_axis(similarities, top, axis=1))
+    
+    def similar_user_item_scores(self, similar_idx, similar_scores):
+        """(batch x products) CSR of similarity-weighted sums of each row's similar users' items"""
+        lengths = np.array([len(idx) for idx in similar_idx])
+        weights = sparse.csr_matrix(
+            (np.concatenate(similar_scores).astype(np.float32),
+             np.concatenate(similar_idx).astype(np.int64),
+             np.concatenate([[0], np.cumsum(lengths)])),
+            shape=(len(similar_idx), self.user_factors.shape[0])
+        )
+        product_scores = (weights @ self.user_item_matrix).tocsr()
+        # Row order must not depend on the order similar users were found in
+        product_scores.sort_indices()
+        return product_scores
+    
+    def get_collaborative_recommendations(self, customer_id, n_recommendations=10):
+        """Get recommendations using collaborative filtering"""
+        if self.user_factors is None or customer_id not in self.user_to_idx:
+            return []
+        
+        user_idx = self.user_to_idx[customer_id]
+        
+        with timed('similar_users'):
+            similar_users_idx, similarities = self.find_similar_users(user_idx, 10)
+        if len(similar_users_idx) == 0:
+            return []
+        
+        with timed('cf_scoring'):
+            # Score products liked by similar users: weighted sum of their rows
+            similar_rows = self.user_item_matrix[similar_users_idx]
+            product_scores = similar_rows.T @ similarities
+            
+            # Only products some similar user interacted with are candidates
+            candidates = np.unique(similar_rows.indices)
+            top = candidates[top_k(product_scores[candidates], n_recommendations)]
+            return self.idx_to_product[top].tolist()
+    
+    def score_content_profiles(self, histories, n_recommendations=10):
+        """Content-based top-N for each product history (a list of product-ID lists).
+        
+        Each profile is the mean TF-IDF vector of its products; all profiles are
+        scored against the catalog in one sparse matrix-matrix product.
+        """
+        results = [[] for _ in histories]
+        if self.product_vectors is None:
+            return results
+        
+        rows_per_profile = []
+        for history in histories:
+            rows = self.content_indices(history) if history else np.empty(0, dtype=np.int64)
+            rows_per_profile.append(np.unique(rows[rows >= 0]))
+        active = [i for i, rows in enumerate(rows_per_profile) if len(rows)]
+        if not active:
+            return results
+        
+        # Averaging matrix (profiles x products) turns histories into profiles
+        lengths = np.array([len(rows_per_profile[i]) for i in active])
+        averaging = sparse.csr_matrix(
+            (np.repeat(1.0 / lengths, lengths).astype(np.float32),
+             np.concatenate([rows_per_profile[i] for i in active]),
+             np.concatenate([[0], np.cumsum(lengths)])),
+            shape=(len(active), self.product_vectors.shape[0])
+        )
+        profiles = averaging @ self.product_vectors
+        
+        ranked = self.rank_content_profiles(profiles, [rows_per_profile[i] for i in active], n_recommendations)
+        for i, product_ids in zip(active, ranked):
+            results[i] = product_ids
+        
+        return results
+    
+    def score_customer_content(self, customer_ids, n_recommendations=10):
+        """Content-based top-N per customer from the in-memory history index (no DB query)"""
+        results = [[] for _ in customer_ids]
+        if (self.product_vectors is None or self.history_profiles is None
+                or not len(self.history_customers) or not len(customer_ids)):
+            return results
+        
+        customer_ids = np.asarray(customer_ids, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.history_customers, customer_ids), len(self.history_customers) - 1)
+        known = self.history_customers[pos] == customer_ids
+        # Customers whose history has no active product have an empty profile
+        known &= np.diff(self.history_profiles.indptr)[pos] > 0
+        active = np.flatnonzero(known)
+        if not len(active):
+            return results
+        
+        exclude_rows = []
+        for p in pos[active]:
+            rows = self.content_indices(self.history_products[self.history_indptr[p]:self.history_indptr[p + 1]])
+            exclude_rows.append(rows[rows >= 0])
+        ranked = self.rank_content_profiles(self.history_profiles[pos[active]], exclude_rows, n_recommendations)
+        for i, product_ids in zip(active, ranked):
+            results[i] = product_ids
+        
+        return results
+    
+    def rank_content_profiles(self, profiles, exclude_rows, n_recommendations):
+        """Top-N product IDs for each profile row, skipping the given content rows"""
+        with timed('content_scoring'):
+            scores = np.asarray((profiles @ self.product_vectors.T).todense())
+            
+            results = []
+            for row, rows in enumerate(exclude_rows):
+                profile_scores = scores[row]
+                # Never recommend what the user already has
+                profile_scores[rows] = -np.inf
+                top = top_k(profile_scores, n_recommendations)
+                top = top[np.isfinite(profile_scores[top])]
+                results.append(self.content_product_ids[top].tolist())
+        
+        return results
+    
+    def history_rows(self, customer_id):
+        """Content rows of the customer's indexed history, and its profile row position (or None)"""
+        if self.history_customers is None or not len(self.history_customers):
+            return np.empty(0, dtype=np.int64), None
+        pos = min(np.searchsorted(self.history_customers, customer_id), len(self.history_customers) - 1)
+        if self.history_customers[pos] != customer_id:
+            return np.empty(0, dtype=np.int64), None
+        rows = self.content_indices(self.history_products[self.history_indptr[pos]:self.history_indptr[pos + 1]])
+        return rows[rows >= 0], pos
+    
+    def is_cold_start(self, customer_id):
+        """True if the customer has no orders, views or searches in this model.
+        
+        Needs the history index; without it (or without cold-start tables)
+        every customer goes through the normal path.
+        """
+        if self.popular_products is None or self.history_customers is None:
             return False
+        if customer_id in self.user_to_idx or contains_sorted(self.history_customers, customer_id):
+            return False
+        return self.search_customers is None or not contains_sorted(self.search_customers, customer_id)
+    
+    def get_cold_start_recommendations(self, n_recommendations=10, category_id=None):
+        """Popular products of category_id, or trending ones topped up with the most popular"""
+        if category_id is not None and self.category_ids is not None and contains_sorted(self.category_ids, category_id):
+            pos = np.searchsorted(self.category_ids, category_id)
+            start = self.category_indptr[pos]
+            end = min(start + n_recommendations, self.category_indptr[pos + 1])
+            return self.content_product_ids[self.category_rows[start:end]].tolist()
         
-        print("Training collaborative filtering model...")
-        cf_success = self.train_collaborative_filtering(interactions)
+        product_ids = self.trending_products[:n_recommendations].tolist()
+        if len(product_ids) < n_recommendations:
+            seen = set(product_ids)
+            popular = self.popular_products[:n_recommendations + len(product_ids)].tolist()
+            product_ids += [pid for pid in popular if pid not in seen][:n_recommendations - len(product_ids)]
+        return product_ids
+    
+    def search_ranked_rows(self, customer_id, n, exclude_rows=None):
+        """Content rows best matching the customer's searches, via a few postings lists"""
+        if self.search_customers is None or self.term_indptr is None or not len(self.search_customers):
+            return np.empty(0, dtype=np.int64)
+        pos = min(np.searchsorted(self.search_customers, customer_id), len(self.search_customers) - 1)
+        if self.search_customers[pos] != customer_id:
+            return np.empty(0, dtype=np.int64)
         
-        print("Training content-based model...")
-        cb_success = self.train_content_based(products)
+        # The profile row's nonzeros, sliced directly (cheaper than a CSR row)
+        start, end = self.search_profiles.indptr[pos], self.search_profiles.indptr[pos + 1]
+        terms, weights = self.search_profiles.indices[start:end], self.search_profiles.data[start:end]
+        strongest = top_k(weights, SEARCH_TERMS_PER_QUERY)
+        rows = []
+        contributions = []
+        for term, weight in zip(terms[strongest], weights[strongest]):
+            start = self.term_indptr[term]
+            end = min(start + SEARCH_POSTINGS_PER_TERM, self.term_indptr[term + 1])
+            rows.append(self.term_rows[start:end])
+            contributions.append(weight * self.term_weights[start:end])
+        if not rows:
+            return np.empty(0, dtype=np.int64)
         
-        if cf_success or cb_success:
-            self.model_trained_at = datetime.now()
-            self.save_models()
-            print("Models trained and saved successfully!")
-            return True
+        # Sum each product's contributions over the looked-up terms
+        candidates, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions))
+        if exclude_rows is not None and len(exclude_rows):
+            scores[np.isin(candidates, exclude_rows)] = -np.inf
+        top = top_k(scores, n)
+        return candidates[top[np.isfinite(scores[top])]]
+    
+    def get_search_recommendations(self, customer_id, n_recommendations=10):
+        """Products matching the customer's recent searches (not already ordered or viewed)"""
+        history_rows, _ = self.history_rows(customer_id)
+        rows = self.search_ranked_rows(customer_id, n_recommendations, history_rows)
+        return self.content_product_ids[rows].tolist()
+    
+    def get_two_stage_recommendations(self, customer_id, n_recommendations=10):
+        """Hybrid recommendations scored on a bounded candidate set.
         
-        return False
+        Candidates come from similar users' items, the customer's searches, the
+        item-item neighbors of their history and the popular products of its
+        categories, capped at CANDIDATES_MAX; content scores are computed for
+        those only.
+        """
+        return self.get_two_stage_recommendations_batch([customer_id], n_recommendations)[customer_id]
     
-    def save_models(self):
-        """Save trained models to disk"""
-        models = {
-            'svd_model': self.svd_model,
-            'tfidf_vectorizer': self.tfidf_vectorizer,
-            'product_features': self.product_features,
-            'user_item_matrix': self.user_item_matrix,
-            'user_to_idx': self.user_to_idx,
-            'product_to_idx': self.product_to_idx,
-            'trained_at': self.model_trained_at.isoformat() if self.model_trained_at else None
+    def get_two_stage_recommendations_batch(self, customer_ids, n_recommendations=10):
+        """Two-stage hybrid recommendations for many customers: {customer_id: [product_id, ...]}.
+        
+        Similar users and their items' CF scores come from one matrix-matrix
+        and one sparse product for the whole batch, and every customer's
+        candidates are content-scored in one pass; only candidate assembly
+        and the bounded top-k run per customer.
+        """
+        n_lists = n_recommendations * 2
+        cf_candidates = {}
+        known = []
+        if self.user_factors is not None:
+            known = [customer_id for customer_id in customer_ids if customer_id in self.user_to_idx]
+        if known:
+            user_rows = np.array([self.user_to_idx[customer_id] for customer_id in known])
+            with timed('similar_users'):
+                similar_idx, similar_scores = self.find_similar_users_batch(user_rows, 10)
+            with timed('cf_scoring'):
+                product_scores = self.similar_user_item_scores(similar_idx, similar_scores)
+                for i, customer_id in enumerate(known):
+                    start, end = product_scores.indptr[i], product_scores.indptr[i + 1]
+                    candidates = product_scores.indices[start:end]
+                    top = top_k(product_scores.data[start:end], CANDIDATES_CF)
+                    cf_candidates[customer_id] = self.idx_to_product[candidates[top]]
+        empty = np.empty(0, dtype=np.int64)
+        cf_ids = {customer_id: cf_candidates.get(customer_id, empty) for customer_id in customer_ids}
+        
+        histories = {customer_id: self.history_rows(customer_id) for customer_id in customer_ids}
+        with timed('search'):
+            search_rows = {
+                customer_id: self.search_ranked_rows(customer_id, CANDIDATES_SEARCH, histories[customer_id][0])
+                for customer_id in customer_ids
+            }
+        
+        cb_ids = {}
+        scored = []
+        if self.product_vectors is not None:
+            scored = [customer_id for customer_id in customer_ids
+                      if histories[customer_id][1] is not None and len(histories[customer_id][0])]
+        if scored:
+            with timed('candidates'):
+                # The history index is in product ID order; expand the items
+                # closest to the customer's profile instead of the lowest IDs
+                expanded = {customer_id: histories[customer_id][0] for customer_id in scored}
+                long_histories = [customer_id for customer_id in scored
+                                  if len(histories[customer_id][0]) > CANDIDATES_HISTORY_ITEMS]
+                closeness = self.profile_scores([histories[customer_id] for customer_id in long_histories])
+                for customer_id, scores in zip(long_histories, closeness):
+                    expanded[customer_id] = histories[customer_id][0][top_k(scores, CANDIDATES_HISTORY_ITEMS)]
+                candidates = {
+                    customer_id: self.two_stage_candidates(
+                        cf_ids[customer_id], search_rows[customer_id], histories[customer_id][0], expanded[customer_id]
+                    )
+                    for customer_id in scored
+                }
+            
+            with timed('content_scoring'):
+                content_scores = self.profile_scores(
+                    [(candidates[customer_id], histories[customer_id][1]) for customer_id in scored]
+                )
+                for customer_id, scores in zip(scored, content_scores):
+                    top = top_k(scores, n_lists)
+                    cb_ids[customer_id] = self.content_product_ids[candidates[customer_id][top]].tolist()
+        for customer_id in customer_ids:
+            if customer_id not in cb_ids:
+                # No history to build a content profile from: searches stand in for it
+                cb_ids[customer_id] = self.content_product_ids[search_rows[customer_id][:n_lists]].tolist()
+        
+        with timed('hybrid_merge'):
+            return {
+                customer_id: merge_hybrid(cf_ids[customer_id][:n_lists].tolist(), cb_ids[customer_id], n_recommendations)
+                for customer_id in customer_ids
+            }
+    
+    def two_stage_candidates(self, cf_ids, search_rows, history_rows, expanded):
+        """Content rows to re-rank for one customer, in priority order, capped at CANDIDATES_MAX"""
+        sources = [self.content_indices(cf_ids), search_rows]
+        if self.neighbor_idx is not None:
+            sources.append(np.asarray(self.neighbor_idx[expanded, :CANDIDATES_PER_ITEM]).ravel())
+        if self.category_ids is not None:
+            for category in np.unique(self.content_categories[expanded]):
+                c = np.searchsorted(self.category_ids, category)
+                start = self.category_indptr[c]
+                sources.append(self.category_rows[start:min(start + CANDIDATES_PER_CATEGORY,
+                                                            self.category_indptr[c + 1])])
+        candidates = np.concatenate(sources).astype(np.int64)
+        candidates = candidates[(candidates >= 0) & ~np.isin(candidates, history_rows)]
+        # The first CANDIDATES_MAX distinct rows are kept
+        _, first = np.unique(candidates, return_index=True)
+        return candidates[np.sort(first)][:CANDIDATES_MAX]
+    
+    def profile_scores(self, requests):
+        """Content scores of many (product rows, history profile position) pairs in one pass.
+        
+        The profiles are few and short (TF-IDF max_features), so they are
+        densified and each stacked product vector nonzero is multiplied with
+        its own customer's profile entry.
+        """
+        lengths = np.array([len(rows) for rows, _ in requests], dtype=np.int64)
+        if not lengths.sum():
+            return [np.empty(0, dtype=np.float32) for _ in requests]
+        vectors = self.product_vectors[np.concatenate([rows for rows, _ in requests])]
+        profiles = self.history_profiles[np.array([pos for _, pos in requests])].toarray()
+        nonzero_rows = np.repeat(np.arange(vectors.shape[0]), np.diff(vectors.indptr))
+        owners = np.repeat(np.arange(len(requests)), lengths)[nonzero_rows]
+        scores = np.bincount(nonzero_rows, weights=vectors.data * profiles[owners, vectors.indices],
+                             minlength=vectors.shape[0]).astype(np.float32)
+        return np.split(scores, np.cumsum(lengths)[:-1])
+    
+    def get_collaborative_recommendations_batch(self, customer_ids, n_recommendations=10):
+        """Collaborative recommendations for many customers: {customer_id: [product_id, ...]}.
+        
+        Similar users for the whole batch come from one factors matrix-matrix
+        product, and their items are scored with one sparse product.
+        """
+        results = {customer_id: [] for customer_id in customer_ids}
+        known = [customer_id for customer_id in customer_ids if customer_id in self.user_to_idx]
+        if self.user_factors is None or not known:
+            return results
+        
+        user_rows = np.array([self.user_to_idx[customer_id] for customer_id in known])
+        product_scores = self.similar_user_item_scores(*self.find_similar_users_batch(user_rows, 10))
+        
+        for i, customer_id in enumerate(known):
+            start, end = product_scores.indptr[i], product_scores.indptr[i + 1]
+            candidates = product_scores.indices[start:end]
+            top = top_k(product_scores.data[start:end], n_recommendations)
+            results[customer_id] = self.idx_to_product[candidates[top]].tolist()
+        
+        return results
+    
+    def get_similar_product_ids(self, product_id, n_recommendations=10):
+        """Get products most similar to product_id (None if it is unknown)"""
+        if self.product_vectors is None:
+            return None
+        
+        row = self.content_indices([product_id])[0]
+        if row < 0:
+            return None
+        
+        # Serve from the precomputed neighbor table when it is deep enough
+        if self.neighbor_idx is not None and n_recommendations <= self.neighbor_idx.shape[1]:
+            neighbors = self.neighbor_idx[row, :n_recommendations]
+            neighbors = neighbors[neighbors >= 0]
+            return self.content_product_ids[neighbors].tolist()
+        
+        scores = np.asarray((self.product_vectors @ self.product_vectors[row].T).todense()).ravel()
+        scores[row] = -np.inf
+        top = top_k(scores, n_recommendations)
+        top = top[np.isfinite(scores[top])]
+        return self.content_product_ids[top].tolist()
+
+class TrainingJobs:
+    """Background training jobs, run one at a time on a single worker thread.
+    
+    Job status is also written to JOBS_DIR as JSON so that any gunicorn worker
+    can answer GET /train/<job_id>, not just the one running the job.
+    """
+    
+    def __init__(self, directory=JOBS_DIR, keep=JOBS_KEEP):
+        self.directory = directory
+        self.keep = keep
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='training')
+        if hasattr(os, 'register_at_fork'):
+            # An executor created in the gunicorn master has no thread in the workers
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+    
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='training')
+    
+    def _write(self, job):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = os.path.join(self.directory, f"{job['job_id']}.json.tmp")
+            with open(tmp_path, 'w') as f:
+                json.dump(job, f)
+            os.replace(tmp_path, os.path.join(self.directory, f"{job['job_id']}.json"))
+        except OSError as e:
+            print(f"Could not write training job status: {e}")
+    
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields)
+            snapshot = dict(job)
+        self._write(snapshot)
+    
+    def submit(self, mode, run):
+        """Queue run(progress) and return the new job's status.
+        
+        run returns the version of the model it published, or None on failure.
+        """
+        job_id = uuid.uuid4().hex
+        job = {
+            'job_id': job_id,
+            'mode': mode,
+            'status': 'queued',
+            'stage': None,
+            'progress': 0.0,
+            'message': None,
+            'trained_at': None,
+            'created_at': datetime.now().isoformat(),
+            'started_at': None,
+            'finished_at': None,
         }
+        with self._lock:
+            self._jobs[job_id] = job
+        self._write(job)
+        self._prune()
+        self._executor.submit(self._run, job_id, run)
+        return dict(job)
+    
+    def _prune(self):
+        """Forget finished jobs beyond the newest `keep`, in memory and on disk"""
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items()
+                        if job['status'] in ('succeeded', 'failed')]
+            for job_id in finished[:max(0, len(finished) - self.keep)]:
+                del self._jobs[job_id]
+            active = {job_id for job_id, job in self._jobs.items() if job['status'] in ('queued', 'running')}
+        files = []
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.json') and entry.name[:-len('.json')] not in active:
+                    try:
+                        files.append((entry.stat().st_mtime, entry.path))
+                    except OSError:
+                        pass  # pruned by another worker
+        except OSError:
+            return
+        # Running jobs of other workers rewrite their file on every update,
+        # so the oldest files are finished or abandoned jobs
+        files.sort()
+        for _, path in files[:max(0, len(files) - self.keep)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def _run(self, job_id, run):
+        self.update(job_id, status='running', started_at=datetime.now().isoformat())
         
-        with open(f'{MODELS_DIR}/recommendation_models.pkl', 'wb') as f:
-            pickle.dump(models, f)
+        def progress(stage, fraction):
+            self.update(job_id, stage=stage, progress=round(fraction, 3))
+        
+        try:
+            version = run(progress)
+            if version:
+                self.update(job_id, status='succeeded', progress=1.0, trained_at=version,
+                            finished_at=datetime.now().isoformat())
+            else:
+                self.update(job_id, status='failed', message='Failed to train models - insufficient data',
+                            finished_at=datetime.now().isoformat())
+        except Exception as e:
+            self.update(job_id, status='failed', message=f'Error training models: {str(e)}',
+                        finished_at=datetime.now().isoformat())
     
-    def load_models(self):
-        """Load trained models from disk"""
+    def get(self, job_id):
+        """Job status by ID (from this process or the shared status files)"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self.directory, f'{job_id}.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+class RecommendationService:
+    def __init__(self):
+        self.db_pool = ConnectionPool()
+        self.product_cache = ProductCache()
+        self.result_cache = create_result_cache()
+        self.precomputed = PrecomputedStore()
+        self.jobs = TrainingJobs()
+        self.model = ModelSnapshot()
+        self._training_lock = threading.RLock()
+        self._reload_lock = threading.Lock()
+        self._manifest_mtime = None
+        self._watcher_pid = None
+        self.branch_pool = ThreadPoolExecutor(max_workers=HYBRID_POOL_SIZE, thread_name_prefix='hybrid')
+        self.branch_stats = {'collaborative_timeouts': 0, 'content_timeouts': 0, 'errors': 0}
+        self.last_training = None
+        if hasattr(os, 'register_at_fork'):
+            # Pool threads started in the gunicorn master do not exist in workers
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+    
+    def _reset_after_fork(self):
+        self.branch_pool = ThreadPoolExecutor(max_workers=HYBRID_POOL_SIZE, thread_name_prefix='hybrid')
+    
+    def __getattr__(self, name):
+        # Read-only access to the current model's fields (svd_model, user_to_idx, ...)
+        if name == 'model':
+            raise AttributeError(name)
+        return getattr(self.model, name)
+    
+    @property
+    def model_version(self):
+        return self.model.model_version
+    
+    def publish_model(self, model):
+        """Make model the one requests use (a single reference assignment)"""
+        self.model = model
+    
+    def is_ready(self):
+        """True once a trained model is loaded and requests can be answered"""
+        model = self.model
+        return model.has_collaborative or model.product_vectors is not None
+    
+    def ensure_ready(self):
+        """Ready, loading the saved artifact if needed (never trains on the request path)"""
+        return self.is_ready() or self.reload_if_changed()
+    
+    def reload_if_changed(self):
+        """Load the artifact on disk if it is not the current model.
+        
+        A stat of manifest.json decides whether anything changed, so this is
+        cheap enough to call from every worker on a timer.
+        """
+        manifest_path = os.path.join(ARTIFACT_DIR, 'manifest.json')
+        with self._reload_lock:
+            try:
+                mtime = os.stat(manifest_path).st_mtime_ns
+            except OSError:
+                return False
+            if mtime == self._manifest_mtime:
+                return False
+            
+            # A training run in this process publishes its own model
+            if not self._training_lock.acquire(blocking=False):
+                return False
+            try:
+                with open(manifest_path) as f:
+                    directory = json.load(f)['directory']
+                if directory == self.model.artifact_directory:
+                    self._manifest_mtime = mtime
+                    return False
+                model = ModelSnapshot()
+                model.load_artifact()
+                self.publish_model(model)
+                self._manifest_mtime = mtime
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error reloading models: {e}")
+                return False
+            finally:
+                self._training_lock.release()
+        
+        print(f"Loaded model artifact {model.artifact_directory} (trained {model.model_version})")
+        return True
+    
+    def preload_models(self):
+        """Load saved models without ever training.
+        
+        Safe at import time in the gunicorn master (preload_app): the artifact
+        is memory-mapped, so every forked worker starts ready and shares its pages.
+        """
+        if self.reload_if_changed():
+            return True
+        if not self.is_ready() and os.path.exists(LEGACY_MODEL_PATH):
+            try:
+                model = ModelSnapshot()
+                model.load_legacy_pickle()
+                self.publish_model(model)
+            except Exception as e:
+                print(f"Error loading models: {e}")
+        return self.is_ready()
+    
+    def start_model_watcher(self, interval=MODEL_RELOAD_INTERVAL):
+        """Start this process's background thread that picks up newer artifacts"""
+        if interval <= 0 or self._watcher_pid == os.getpid():
+            return
+        with self._reload_lock:
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+        threading.Thread(target=self._watch_models, args=(interval,), name='model-watcher', daemon=True).start()
+    
+    def _watch_models(self, interval):
+        while True:
+            try:
+                self.reload_if_changed()
+                if not self.is_ready():
+                    self.train_on_first_start()
+            except Exception as e:
+                print(f"Error checking for new models: {e}")
+            time.sleep(interval)
+    
+    def train_on_first_start(self):
+        """Train once across all workers when no saved model exists yet"""
+        if os.path.exists(os.path.join(ARTIFACT_DIR, 'manifest.json')) or os.path.exists(LEGACY_MODEL_PATH):
+            return False
+        
+        # Only the worker that creates the lock file trains; the others pick
+        # up its artifact. A lock left behind by a crashed worker expires; one
+        # left by a failed training is a cooldown before the next attempt.
+        os.makedirs(MODELS_DIR, exist_ok=True)
+        lock_path = os.path.join(MODELS_DIR, '.first_training.lock')
+        try:
+            with open(lock_path) as f:
+                expires_after = FIRST_TRAINING_RETRY_SECONDS if f.read().startswith('failed') else 3600
+            if time.time() - os.stat(lock_path).st_mtime > expires_after:
+                os.remove(lock_path)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        
+        trained = False
         try:
-            with open(f'{MODELS_DIR}/recommendation_models.pkl', 'rb') as f:
-                models = pickle.load(f)
+            print("No saved models found. Training new models...")
+            trained = self.train_models()
+            return trained
+        finally:
+            if trained:
+                os.remove(lock_path)
+            else:
+                print(f"First training failed; retrying in {FIRST_TRAINING_RETRY_SECONDS:.0f}s")
+                try:
+                    with open(lock_path, 'w') as f:
+                        f.write(f'failed {datetime.now().isoformat()}\n')
+                except OSError:
+                    pass  # the empty lock still expires, after an hour
+    
+    def db_connection(self):
+        """Borrow a pooled database connection (use as a context manager)"""
+        return self.db_pool.connection()
+    
+    def hydrate_encoded(self, product_ids, fields=None):
+        """{product_id: product JSON} for product_ids, in order, skipping inactive ones.
+        
+        Products come from the product cache; only misses are fetched, in one
+        query that selects just `fields` (see parse_fields). Each row is
+        JSON-encoded once when it is cached, so responses only join strings.
+        """
+        if not product_ids:
+            return {}
+        
+        entries, missing = self.product_cache.get_many(product_ids, fields)
+        
+        if missing:
+            with self.db_connection() as conn:
+                if conn:
+                    with timed('hydrate_query'):
+                        cursor = conn.cursor(dictionary=True)
+                        cursor.execute(hydrate_query(fields, ','.join(['%s'] * len(missing))), missing)
+                        fetched = {row['product_id']: row for row in cursor.fetchall()}
+                        cursor.close()
+                    
+                    fetched = {
+                        product_id: app.json.dumps(fetched[product_id]) if product_id in fetched else None
+                        for product_id in missing
+                    }
+                    self.product_cache.put_many(fetched, fields)
+                    entries.update(fetched)
+        
+        return {product_id: entries[product_id] for product_id in product_ids if entries.get(product_id)}
+    
+    def load_training_data(self):
+        """Stream training data from the database into column arrays.
+        
+        Rows are read from unbuffered cursors FETCH_BATCH_SIZE at a time and
+        appended to typed arrays, so no per-row Python dicts are built.
+        """
+        with self.db_connection() as conn:
+            if not conn:
+                return None, None, None, None, None
+            
+            # Get user-item interactions (purchases)
+            cursor = conn.cursor(buffered=False)
+            cursor.execute("""
+                SELECT customer_id, product_id, SUM(quantity) as total_quantity, COUNT(*) as order_count
+                FROM orders
+                WHERE status IN ('delivered', 'completed', 'confirmed', 'preparing', 'packed', 'for_pickup', 'out_for_delivery')
+                AND payment_status = 'paid'
+                GROUP BY customer_id, product_id
+            """)
+            interactions = fetch_columns(cursor, INTERACTION_COLUMNS)
+            cursor.close()
+            
+            # Get product features
+            cursor = conn.cursor(buffered=False)
+            cursor.execute("""
+                SELECT p.product_id, p.name, p.description, p.category_id, p.price,
+                       c.name as category_name,
+                       COALESCE(AVG(r.rating), 0) as avg_rating,
+                       COUNT(DISTINCT o.orders_id) as purchase_count
+                FROM product p
+                LEFT JOIN category c ON p.category_id = c.category_id
+                LEFT JOIN orders o ON p.product_id = o.product_id 
+                    AND o.status IN ('delivered', 'completed', 'confirmed')
+                LEFT JOIN rating r ON o.orders_id = r.orders_id
+                WHERE p.status = 'active'
+                AND (p.moderation_status = 'approved' OR p.moderation_status IS NULL)
+                GROUP BY p.product_id
+            """)
+            products = fetch_columns(cursor, PRODUCT_COLUMNS)
+            cursor.close()
+            
+            # Get user searches
+            cursor = conn.cursor(buffered=False)
+            cursor.execute("""
+                SELECT customer_id, search_term, category_id, COUNT(*) as search_count
+                FROM user_searches
+                WHERE created_at >= DATE_SUB(NOW(), INTERVAL 90 DAY)
+                GROUP BY customer_id, search_term, category_id
+            """)
+            searches = fetch_columns(cursor, SEARCH_COLUMNS)
+            cursor.close()
+            
+            # Products each customer ordered or viewed, for content-based profiles
+            cursor = conn.cursor(buffered=False)
+            cursor.execute("""
+                SELECT customer_id, product_id FROM orders
+                UNION
+                SELECT customer_id, product_id FROM product_views
+            """)
+            history = fetch_columns(cursor, HISTORY_COLUMNS)
+            cursor.close()
+            
+            # Orders and weighted views per product, overall and in the trending window
+            cursor = conn.cursor(buffered=False)
+            cursor.execute(f"""
+                SELECT product_id, SUM(weight) as popularity,
+                       SUM(CASE WHEN event_at >= DATE_SUB(NOW(), INTERVAL {TRENDING_DAYS} DAY) THEN weight ELSE 0 END) as trending
+                FROM (
+                    SELECT product_id, 1.0 as weight, created_at as event_at FROM orders
+                    WHERE status IN ('delivered', 'completed', 'confirmed', 'preparing', 'packed', 'for_pickup', 'out_for_delivery')
+                    UNION ALL
+                    SELECT product_id, %s as weight, viewed_at as event_at FROM product_views
+                ) events
+                GROUP BY product_id
+            """, (POPULARITY_VIEW_WEIGHT,))
+            popularity = fetch_columns(cursor, POPULARITY_COLUMNS)
+            cursor.close()
+            
+            return interactions, products, searches, history, popularity
+    
+    def train_models(self, progress=None):
+        """Train all recommendation models into a new snapshot and publish it"""
+        progress = progress or (lambda stage, fraction: None)
+        with self._training_lock:
+            # Taken before loading: incremental runs fold in everything since,
+            # including rows written while this training was running
+            started_at = datetime.now()
+            started = time.perf_counter()
+            print("Loading training data...")
+            progress('loading', 0.05)
+            interactions, products, searches, history, popularity = self.load_training_data()
+            
+            if not row_count(interactions) and not row_count(products):
+                print("No data available for training")
+                return False
+            
+            model = ModelSnapshot()
+            
+            print("Training collaborative filtering model...")
+            progress('collaborative', 0.3)
+            cf_success = model.train_collaborative_filtering(
+                interactions, progress=lambda fraction: progress('collaborative', 0.3 + 0.3 * fraction)
+            )
+            
+            print("Training content-based model...")
+            progress('content', 0.6)
+            cb_success = model.train_content_based(products)
+            model.build_history(history['customer_id'], history['product_id'])
+            if cb_success:
+                model.build_term_index()
+                model.build_search_profiles(searches)
+                model.build_popularity(products, popularity)
+            
+            if cf_success and USER_INDEX == 'ivf':
+                print("Building similar-user index...")
+                progress('user_index', 0.8)
+                model.build_user_index()
+            
+            if cf_success or cb_success:
+                model.model_trained_at = started_at
+                model.model_full_trained_at = model.model_trained_at
+                progress('saving', 0.9)
+                model.save()
+                self.publish_model(model)
+                self.record_training('full', time.perf_counter() - started)
+                print("Models trained and saved successfully!")
+                return True
+            
+            return False
+    
+    def load_incremental_data(self, since):
+        """Load interactions of customers who ordered since `since`, and new products, history and searches"""
+        with self.db_connection() as conn:
+            if not conn:
+                return None, None, None, None
+            
+            # Full purchase history of every customer with a new or recently
+            # changed order (an order placed earlier may only now be paid)
+            cursor = conn.cursor(buffered=False)
+            cursor.execute(f"""
+                SELECT o.customer_id, o.product_id, SUM(o.quantity) as total_quantity, COUNT(*) as order_count
+                FROM orders o
+                JOIN (
+                    SELECT DISTINCT customer_id FROM orders WHERE {ORDERS_CHANGED_COLUMN} >= %s
+                ) changed ON o.customer_id = changed.customer_id
+                WHERE o.status IN ('delivered', 'completed', 'confirmed', 'preparing', 'packed', 'for_pickup', 'out_for_delivery')
+                AND o.payment_status = 'paid'
+                GROUP BY o.customer_id, o.product_id
+            """, (since - timedelta(days=INCREMENTAL_ORDER_LOOKBACK_DAYS),))
+            interactions = fetch_columns(cursor, INTERACTION_COLUMNS)
+            cursor.close()
+            
+            # Products created since the last update
+            cursor = conn.cursor(buffered=False)
+            cursor.execute("""
+                SELECT p.product_id, p.name, p.description, p.category_id, p.price,
+                       c.name as category_name,
+                       0 as avg_rating,
+                       0 as purchase_count
+                FROM product p
+                LEFT JOIN category c ON p.category_id = c.category_id
+                WHERE p.status = 'active'
+                AND (p.moderation_status = 'approved' OR p.moderation_status IS NULL)
+                AND p.created_at >= %s
+            """, (since,))
+            products = fetch_columns(cursor, PRODUCT_COLUMNS)
+            cursor.close()
             
-            self.svd_model = models.get('svd_model')
-            self.tfidf_vectorizer = models.get('tfidf_vectorizer')
-            self.product_features = models.get('product_features', {})
-            self.user_item_matrix = models.get('user_item_matrix')
-            self.user_to_idx = models.get('user_to_idx', {})
-            self.product_to_idx = models.get('product_to_idx', {})
+            # Products ordered or viewed since the last update
+            cursor = conn.cursor(buffered=False)
+            cursor.execute("""
+                SELECT customer_id, product_id FROM orders WHERE created_at >= %s
+                UNION
+                SELECT customer_id, product_id FROM product_views WHERE viewed_at >= %s
+            """, (since, since))
+            history = fetch_columns(cursor, HISTORY_COLUMNS)
+            cursor.close()
+            
+            # Searches since the last update
+            cursor = conn.cursor(buffered=False)
+            cursor.execute("""
+                SELECT customer_id, search_term, category_id, COUNT(*) as search_count
+                FROM user_searches
+                WHERE created_at >= %s
+                GROUP BY customer_id, search_term, category_id
+            """, (since,))
+            searches = fetch_columns(cursor, SEARCH_COLUMNS)
+            cursor.close()
+            
+            return interactions, products, history, searches
+    
+    def update_models_incremental(self, progress=None):
+        """Fold orders and products since the last update into the models.
+        
+        Falls back to a full retrain when there is no model yet or the last
+        full retrain is older than FULL_RETRAIN_INTERVAL_HOURS.
+        """
+        progress = progress or (lambda stage, fraction: None)
+        with self._training_lock:
+            model = self.model
+            if (not model.has_collaborative or model.tfidf_vectorizer is None or not model.model_full_trained_at
+                    or datetime.now() - model.model_full_trained_at > timedelta(hours=FULL_RETRAIN_INTERVAL_HOURS)):
+                print("Full retrain due; running full training...")
+                return self.train_models(progress)
+            
+            since = model.model_trained_at
+            started_at = datetime.now()
+            started = time.perf_counter()
+            print(f"Loading data since {since.isoformat()}...")
+            progress('loading', 0.1)
+            interactions, products, history, searches = self.load_incremental_data(since)
+            if interactions is None:
+                return False
+            
+            progress('fold_in', 0.5)
+            model = model.folded_in(interactions, products, history, searches, started_at)
+            progress('saving', 0.9)
+            model.save()
+            self.publish_model(model)
+            self.record_training('incremental', time.perf_counter() - started)
             
-            if models.get('trained_at'):
-                self.model_trained_at = datetime.fromisoformat(models['trained_at'])
+            print(f"Folded in {row_count(interactions)} interactions, {row_count(products)} products, "
+                  f"{row_count(history)} history rows and {row_count(searches)} searches")
+            return True
+    
+    def record_training(self, mode, seconds):
+        self.last_training = {'mode': mode, 'seconds': seconds, 'finished_at': time.time()}
+        METRICS.observe('recommendation_training_duration_seconds', seconds, mode=mode)
+    
+    def start_training_job(self, mode='full'):
+        """Run training in the background; returns the job status"""
+        train = self.update_models_incremental if mode == 'incremental' else self.train_models
+        
+        def run(progress):
+            return self.model_version if train(progress) else None
+        
+        return self.jobs.submit(mode, run)
+    
+    def save_models(self):
+        """Save the current model to disk"""
+        return self.model.save()
+    
+    def load_models(self):
+        """Load trained models from disk (artifact directory, else legacy pickle)"""
+        try:
+            model = ModelSnapshot()
+            if os.path.exists(os.path.join(ARTIFACT_DIR, 'manifest.json')):
+                model.load_artifact()
+            else:
+                model.load_legacy_pickle()
+            self.publish_model(model)
             
             # Check if models are stale (older than 7 days) - retrain if needed
-            if self.model_trained_at:
-                days_old = (datetime.now() - self.model_trained_at).days
+            if model.model_trained_at:
+                days_old = (datetime.now() - model.model_trained_at).days
                 if days_old > 7:
                     print(f"Models are {days_old} days old. Consider retraining.")
             
@@ -287,122 +2839,316 @@ class RecommendationService:
             print("Attempting to train new models...")
             return self.train_models()
     
-    def get_collaborative_recommendations(self, customer_id, n_recommendations=10):
+    def get_collaborative_recommendations(self, customer_id, n_recommendations=10, model=None):
         """Get recommendations using collaborative filtering"""
-        if not self.svd_model or customer_id not in self.user_to_idx:
+        model = model or self.model
+        return model.get_collaborative_recommendations(customer_id, n_recommendations)
+    
+    def get_content_based_recommendations(self, customer_id, n_recommendations=10, model=None):
+        """Get recommendations based on user's viewed/purchased products"""
+        model = model or self.model
+        if model.product_vectors is None:
             return []
+        if model.history_customers is not None:
+            return model.score_customer_content([customer_id], n_recommendations)[0]
         
-        user_idx = self.user_to_idx[customer_id]
-        user_vector = self.user_item_matrix[user_idx:user_idx+1]
-        
-        # Transform to latent space
-        user_latent = self.svd_model.transform(user_vector)
+        # Models saved without a history index fall back to the database
+        with self.db_connection() as conn:
+            if not conn:
+                return []
+            
+            with timed('history_query'):
+                cursor = conn.cursor(dictionary=True)
+                
+                # Get user's interacted products
+                cursor.execute("""
+                    SELECT DISTINCT product_id FROM (
+                        SELECT product_id FROM orders WHERE customer_id = %s
+                        UNION
+                        SELECT product_id FROM product_views WHERE customer_id = %s
+                    ) as interacted
+                    LIMIT 20
+                """, (customer_id, customer_id))
+                user_products = [row['product_id'] for row in cursor.fetchall()]
+                cursor.close()
         
-        # Transform all users to latent space
-        all_users_latent = self.svd_model.transform(self.user_item_matrix)
+        if not user_products:
+            return []
         
-        # Find similar users
-        similarities = cosine_similarity(user_latent, all_users_latent)[0]
-        similar_users_idx = np.argsort(similarities)[::-1][1:11]  # Top 10 similar users
+        return model.score_content_profiles([user_products], n_recommendations)[0]
+    
+    def get_user_histories(self, customer_ids):
+        """Products each customer ordered or viewed (at most 20 each), in one query"""
+        histories = {customer_id: [] for customer_id in customer_ids}
+        if not customer_ids:
+            return histories
         
-        # Get products liked by similar users
-        product_scores = {}
-        for similar_user_idx in similar_users_idx:
-            user_products = np.where(self.user_item_matrix[similar_user_idx] > 0)[0]
-            for product_idx in user_products:
-                product_id = list(self.product_to_idx.keys())[list(self.product_to_idx.values()).index(product_idx)]
-                if product_id not in product_scores:
-                    product_scores[product_id] = 0
-                product_scores[product_id] += similarities[similar_user_idx] * self.user_item_matrix[similar_user_idx, product_idx]
+        with self.db_connection() as conn:
+            if not conn:
+                return histories
+            
+            cursor = conn.cursor(dictionary=True)
+            placeholders = ','.join(['%s'] * len(customer_ids))
+            cursor.execute(f"""
+                SELECT customer_id, product_id FROM orders WHERE customer_id IN ({placeholders})
+                UNION
+                SELECT customer_id, product_id FROM product_views WHERE customer_id IN ({placeholders})
+            """, list(customer_ids) + list(customer_ids))
+            for row in cursor.fetchall():
+                history = histories.get(row['customer_id'])
+                if history is not None and len(history) < 20:
+                    history.append(row['product_id'])
+            cursor.close()
         
-        # Sort by score and return top N
-        sorted_products = sorted(product_scores.items(), key=lambda x: x[1], reverse=True)
-        return [product_id for product_id, score in sorted_products[:n_recommendations]]
+        return histories
     
-    def get_content_based_recommendations(self, customer_id, n_recommendations=10):
-        """Get recommendations based on user's viewed/purchased products"""
-        conn = self.get_db_connection()
-        if not conn or not self.product_features:
-            return []
-        
-        cursor = conn.cursor(dictionary=True)
+    def hybrid_retrieval(self, model=None):
+        """'two_stage' if enabled and the model has a history index, else 'full'"""
+        model = model or self.model
+        if HYBRID_RETRIEVAL == 'two_stage' and model.history_profiles is not None:
+            return 'two_stage'
+        return 'full'
+    
+    def result_key(self, customer_id, method, n_recommendations, model):
+        """Result cache key; hybrid results of the two retrieval modes are kept apart"""
+        if method == 'hybrid':
+            method = f'hybrid:{self.hybrid_retrieval(model)}'
+        return (customer_id, method, n_recommendations)
+    
+    def get_recommendations_batch(self, customer_ids, method='hybrid', n_recommendations=10):
+        """Ranked product IDs for many customers at once: {customer_id: [product_id, ...]}.
         
-        # Get user's interacted products
-        cursor.execute("""
-            SELECT DISTINCT product_id FROM (
-                SELECT product_id FROM orders WHERE customer_id = %s
-                UNION
-                SELECT product_id FROM product_views WHERE customer_id = %s
-            ) as interacted
-            LIMIT 20
-        """, (customer_id, customer_id))
-        user_products = [row['product_id'] for row in cursor.fetchall()]
-        cursor.close()
+        Hybrid uses the same retrieval as the single-customer path, so both
+        fill the result cache and the precomputed table with the same lists.
+        """
+        model = self.model
+        version = model.model_version
+        two_stage = method == 'hybrid' and self.hybrid_retrieval(model) == 'two_stage'
+        results = {}
+        pending = []
+        for customer_id in customer_ids:
+            if model.is_cold_start(customer_id):
+                METRICS.inc('recommendation_cold_start_total')
+                results[customer_id] = model.get_cold_start_recommendations(n_recommendations)
+                continue
+            cached = None
+            if self.result_cache is not None and version:
+                cached = self.result_cache.get(self.result_key(customer_id, method, n_recommendations, model), version)
+            if cached is not None:
+                results[customer_id] = cached
+            else:
+                pending.append(customer_id)
         
-        if not user_products:
-            return []
+        if pending:
+            n_candidates = n_recommendations if method != 'hybrid' else n_recommendations * 2
+            cf_recs = {}
+            cb_recs = {}
+            if method == 'collaborative' or (method == 'hybrid' and not two_stage):
+                cf_recs = model.get_collaborative_recommendations_batch(pending, n_candidates)
+            if two_stage:
+                two_stage_recs = model.get_two_stage_recommendations_batch(pending, n_recommendations)
+            if method == 'content' or (method == 'hybrid' and not two_stage):
+                if model.history_customers is not None:
+                    scored = model.score_customer_content(pending, n_candidates)
+                else:
+                    histories = self.get_user_histories(pending)
+                    scored = model.score_content_profiles([histories[cid] for cid in pending], n_candidates)
+                cb_recs = dict(zip(pending, scored))
+            
+            for customer_id in pending:
+                if method == 'collaborative':
+                    product_ids = cf_recs[customer_id]
+                elif method == 'content':
+                    product_ids = cb_recs[customer_id]
+                elif method == 'search':
+                    product_ids = model.get_search_recommendations(customer_id, n_recommendations)
+                elif two_stage:
+                    product_ids = two_stage_recs[customer_id]
+                else:  # hybrid, full retrieval
+                    product_ids = merge_hybrid(cf_recs[customer_id], cb_recs[customer_id], n_recommendations)
+                results[customer_id] = product_ids
+                if self.result_cache is not None and version:
+                    key = self.result_key(customer_id, method, n_recommendations, model)
+                    self.result_cache.set(key, version, product_ids)
         
-        # Get average vector of user's products
-        user_product_vectors = []
-        for product_id in user_products:
-            if product_id in self.product_features:
-                user_product_vectors.append(self.product_features[product_id])
+        return results
+    
+    def get_similar_product_ids(self, product_id, n_recommendations=10):
+        """Get products most similar to product_id (None if it is unknown)"""
+        with timed('similar_products'):
+            return self.model.get_similar_product_ids(product_id, n_recommendations)
+    
+    def get_ranked_product_ids(self, customer_id, method='hybrid', n_recommendations=10, category_id=None):
+        """Ranked product IDs for a customer, cached per model version"""
+        model = self.model
+        version = model.model_version
         
-        if not user_product_vectors:
-            return []
+        # Customers the model knows nothing about get the popularity tables
+        if model.is_cold_start(customer_id):
+            with timed('cold_start'):
+                METRICS.inc('recommendation_cold_start_total')
+                return model.get_cold_start_recommendations(n_recommendations, category_id)
         
-        # Average the vectors
-        from scipy.sparse import vstack
-        user_vector = vstack(user_product_vectors).mean(axis=0)
+        with timed('cache_lookup'):
+            # Serve from the offline table when it covers this customer
+            product_ids = None
+            if method == 'hybrid' and version:
+                product_ids = self.precomputed.lookup(
+                    customer_id, n_recommendations, version, self.hybrid_retrieval(model)
+                )
+            
+            key = self.result_key(customer_id, method, n_recommendations, model)
+            if product_ids is None and self.result_cache is not None and version:
+                product_ids = self.result_cache.get(key, version)
+        if product_ids is not None:
+            return product_ids
         
-        # Find similar products
-        product_scores = {}
-        for product_id, product_vector in self.product_features.items():
-            if product_id not in user_products:
-                similarity = cosine_similarity(user_vector, product_vector)[0][0]
-                product_scores[product_id] = similarity
+        if method == 'collaborative':
+            product_ids = self.get_collaborative_recommendations(customer_id, n_recommendations, model)
+        elif method == 'content':
+            product_ids = self.get_content_based_recommendations(customer_id, n_recommendations, model)
+        elif method == 'search':
+            with timed('search'):
+                product_ids = model.get_search_recommendations(customer_id, n_recommendations)
+        else:  # hybrid
+            product_ids = self.get_hybrid_recommendations(customer_id, n_recommendations, model)
         
-        # Sort and return top N
-        sorted_products = sorted(product_scores.items(), key=lambda x: x[1], reverse=True)
-        return [product_id for product_id, score in sorted_products[:n_recommendations]]
+        if self.result_cache is not None and version:
+            self.result_cache.set(key, version, product_ids)
+        return product_ids
     
-    def get_hybrid_recommendations(self, customer_id, n_recommendations=10):
+    def get_hybrid_recommendations(self, customer_id, n_recommendations=10, model=None):
         """Combine collaborative and content-based recommendations"""
-        cf_recs = self.get_collaborative_recommendations(customer_id, n_recommendations * 2)
-        cb_recs = self.get_content_based_recommendations(customer_id, n_recommendations * 2)
+        model = model or self.model
+        # Two-stage retrieval needs no database round trip, so it runs inline
+        if self.hybrid_retrieval(model) == 'two_stage':
+            return model.get_two_stage_recommendations(customer_id, n_recommendations)
+        if HYBRID_EXECUTION == 'concurrent':
+            return self.get_hybrid_recommendations_concurrent(customer_id, n_recommendations, model)
         
-        # Combine and deduplicate
-        combined = {}
+        cf_recs = self.get_collaborative_recommendations(customer_id, n_recommendations * 2, model)
+        cb_recs = self.get_content_based_recommendations(customer_id, n_recommendations * 2, model)
         
-        # Weight collaborative filtering more
-        for idx, product_id in enumerate(cf_recs):
-            combined[product_id] = combined.get(product_id, 0) + (len(cf_recs) - idx) * 2
+        with timed('hybrid_merge'):
+            return merge_hybrid(cf_recs, cb_recs, n_recommendations)
+    
+    def get_hybrid_recommendations_concurrent(self, customer_id, n_recommendations=10, model=None,
+                                              cf_timeout=HYBRID_CF_TIMEOUT, content_timeout=HYBRID_CONTENT_TIMEOUT):
+        """Hybrid recommendations with both branches run at once, each under its own deadline"""
+        model = model or self.model
+        started = time.monotonic()
+        # Each branch runs in a copy of this context so its stage timings reach the response
+        branches = [
+            ('collaborative', cf_timeout, self.branch_pool.submit(
+                contextvars.copy_context().run,
+                self.get_collaborative_recommendations, customer_id, n_recommendations * 2, model
+            )),
+            ('content', content_timeout, self.branch_pool.submit(
+                contextvars.copy_context().run,
+                self.get_content_based_recommendations, customer_id, n_recommendations * 2, model
+            )),
+        ]
         
-        for idx, product_id in enumerate(cb_recs):
-            combined[product_id] = combined.get(product_id, 0) + (len(cb_recs) - idx)
+        results = {}
+        for name, timeout, future in branches:
+            try:
+                results[name] = future.result(timeout=max(0.0, started + timeout - time.monotonic()))
+            except FutureTimeoutError:
+                # Degrade to the other branch; the late one finishes in the background
+                future.cancel()
+                self.branch_stats[f'{name}_timeouts'] += 1
+                METRICS.inc('recommendation_hybrid_branch_timeouts_total', branch=name)
+                print(f"Hybrid {name} branch missed its {timeout}s deadline for customer {customer_id}")
+                results[name] = []
+            except Exception as e:
+                self.branch_stats['errors'] += 1
+                METRICS.inc('recommendation_hybrid_branch_errors_total', branch=name)
+                print(f"Hybrid {name} branch failed for customer {customer_id}: {e}")
+                results[name] = []
         
-        # Sort by score
-        sorted_products = sorted(combined.items(), key=lambda x: x[1], reverse=True)
-        return [product_id for product_id, score in sorted_products[:n_recommendations]]
+        with timed('hybrid_merge'):
+            return merge_hybrid(results['collaborative'], results['content'], n_recommendations)
 
 # Initialize service
 recommendation_service = RecommendationService()
+if PRELOAD_MODELS:
+    recommendation_service.preload_models()
+
+@app.before_request
+def start_model_watcher():
+    # Threads do not survive fork, so each worker starts its own watcher
+    recommendation_service.start_model_watcher()
+
+@app.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    request_timings.set({})
+
+@app.after_request
+def add_server_timing(response):
+    """Record the request duration and send the stage breakdown as Server-Timing"""
+    started = getattr(g, 'request_started', None)
+    if started is None:
+        return response
+    total = time.perf_counter() - started
+    METRICS.observe(
+        'recommendation_http_request_duration_seconds', total,
+        endpoint=request.url_rule.rule if request.url_rule else 'unmatched',
+        method=request.method, status=response.status_code
+    )
+    
+    # Streamed responses only include the stages run before the first chunk
+    timings = request_timings.get() or {}
+    entries = [f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in timings.items()]
+    entries.append(f'total;dur={total * 1000:.2f}')
+    response.headers['Server-Timing'] = ', '.join(entries)
+    return response
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'healthy', 'service': 'recommendation-api'})
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness check: 503 until a trained model is loaded (/health is liveness only)"""
+    ready = recommendation_service.ensure_ready()
+    model = recommendation_service.model
+    return jsonify({
+        'ready': ready,
+        'model_version': model.model_version,
+        'artifact': model.artifact_directory
+    }), 200 if ready else 503
+
 @app.route('/train', methods=['POST'])
 def train_models():
-    """Train recommendation models"""
+    """Start a background training job (?mode=incremental folds in new data only).
+    
+    Returns 202 with a job_id to poll at /train/<job_id>; ?wait=1 trains
+    synchronously instead. Requests keep using the previous model until the
+    new one is published.
+    """
+    mode = 'incremental' if request.args.get('mode') == 'incremental' else 'full'
+    if request.args.get('wait') not in ('1', 'true'):
+        job = recommendation_service.start_training_job(mode)
+        return jsonify({
+            'success': True,
+            'message': 'Training started',
+            'job_id': job['job_id'],
+            'status': job['status'],
+            'status_url': f"/train/{job['job_id']}"
+        }), 202
+    
     try:
-        success = recommendation_service.train_models()
+        if mode == 'incremental':
+            success = recommendation_service.update_models_incremental()
+        else:
+            success = recommendation_service.train_models()
         if success:
             return jsonify({
                 'success': True,
                 'message': 'Models trained successfully',
-                'trained_at': recommendation_service.model_trained_at.isoformat() if recommendation_service.model_trained_at else None
+                'trained_at': recommendation_service.model_version
             })
         else:
             return jsonify({
@@ -415,18 +3161,27 @@ def train_models():
             'message': f'Error training models: {str(e)}'
         }), 500
 
+@app.route('/train/<job_id>', methods=['GET'])
+def training_job_status(job_id):
+    """Status and progress of a background training job"""
+    job = recommendation_service.jobs.get(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'message': 'Training job not found'
+        }), 404
+    return jsonify({'success': True, 'job': job})
+
 @app.route('/recommendations/<int:customer_id>', methods=['GET'])
 def get_recommendations(customer_id):
     """Get product recommendations for a customer"""
     try:
-        # Load models if not loaded
-        if recommendation_service.svd_model is None:
-            if not recommendation_service.load_models():
-                return jsonify({
-                    'success': False,
-                    'message': 'Models not available. Please train models first.',
-                    'products': []
-                }), 503
+        if not recommendation_service.ensure_ready():
+            return jsonify({
+                'success': False,
+                'message': 'Models not available. Please train models first.',
+                'products': []
+            }), 503
         
         # Check if models are stale (older than 7 days)
         if recommendation_service.model_trained_at:
@@ -436,48 +3191,25 @@ def get_recommendations(customer_id):
                 pass
         
         limit = int(request.args.get('limit', 10))
-        method = request.args.get('method', 'hybrid')  # 'collaborative', 'content', or 'hybrid'
+        method = request.args.get('method', 'hybrid')  # 'collaborative', 'content', 'search' or 'hybrid'
+        if method not in ('collaborative', 'content', 'search'):
+            method = 'hybrid'
+        category_id = request.args.get('category_id', type=int)  # used for cold-start customers only
+        try:
+            fields = parse_fields(request.args.get('fields'))
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e), 'products': []}), 400
         
-        if method == 'collaborative':
-            product_ids = recommendation_service.get_collaborative_recommendations(customer_id, limit)
-        elif method == 'content':
-            product_ids = recommendation_service.get_content_based_recommendations(customer_id, limit)
-        else:  # hybrid
-            product_ids = recommendation_service.get_hybrid_recommendations(customer_id, limit)
+        product_ids = recommendation_service.get_ranked_product_ids(customer_id, method, limit, category_id)
         
-        # Get product details from database
-        if product_ids:
-            conn = recommendation_service.get_db_connection()
-            if conn:
-                cursor = conn.cursor(dictionary=True)
-                placeholders = ','.join(['%s'] * len(product_ids))
-                cursor.execute(f"""
-                    SELECT p.*, 
-                           COALESCE(MIN(ps.price), p.price) as min_price,
-                           c.name as category_name,
-                           s.business_name, s.firstname, s.lastname
-                    FROM product p
-                    LEFT JOIN product_size ps ON p.product_id = ps.product_id
-                    LEFT JOIN category c ON p.category_id = c.category_id
-                    LEFT JOIN seller s ON p.seller_id = s.seller_id
-                    WHERE p.product_id IN ({placeholders})
-                    AND p.status = 'active'
-                    GROUP BY p.product_id
-                    ORDER BY FIELD(p.product_id, {placeholders})
-                """, product_ids + product_ids)
-                products = cursor.fetchall()
-                cursor.close()
-            else:
-                products = []
-        else:
-            products = []
+        # Get product details (cached, already JSON-encoded)
+        products = recommendation_service.hydrate_encoded(product_ids, fields)
         
-        return jsonify({
+        return json_with_products({
             'success': True,
-            'products': products,
             'count': len(products),
             'method': method
-        })
+        }, products.values())
         
     except Exception as e:
         return jsonify({
@@ -486,63 +3218,91 @@ def get_recommendations(customer_id):
             'products': []
         }), 500
 
+@app.route('/recommendations/batch', methods=['POST'])
+def get_recommendations_batch():
+    """Recommendations for many customers, streamed back as NDJSON.
+    
+    Body: {"customer_ids": [1, 2, ...], "limit": 10, "method": "hybrid"}
+    Each output line is {"customer_id": ..., "products": [...], "count": ...}.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        customer_ids = [int(cid) for cid in data.get('customer_ids') or []]
+        limit = int(data.get('limit', 10))
+    except (TypeError, ValueError):
+        customer_ids = []
+    if not customer_ids:
+        return jsonify({
+            'success': False,
+            'message': 'customer_ids must be a non-empty list of integers'
+        }), 400
+    
+    method = data.get('method', 'hybrid')
+    if method not in ('collaborative', 'content', 'search'):
+        method = 'hybrid'
+    try:
+        fields = parse_fields(data.get('fields') or request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    if not recommendation_service.ensure_ready():
+        return jsonify({
+            'success': False,
+            'message': 'Models not available. Please train models first.'
+        }), 503
+    
+    def generate():
+        for start in range(0, len(customer_ids), BATCH_CHUNK_SIZE):
+            chunk = customer_ids[start:start + BATCH_CHUNK_SIZE]
+            try:
+                ranked = recommendation_service.get_recommendations_batch(chunk, method, limit)
+                
+                # Hydrate every product of the chunk in one (cached) query
+                all_ids = list(dict.fromkeys(pid for cid in chunk for pid in ranked[cid]))
+                details = recommendation_service.hydrate_encoded(all_ids, fields)
+            except Exception as e:
+                yield app.json.dumps({'success': False, 'message': f'Error getting recommendations: {str(e)}'}) + '\n'
+                return
+            
+            for customer_id in chunk:
+                products = [details[pid] for pid in ranked[customer_id] if pid in details]
+                head = app.json.dumps({'customer_id': customer_id, 'count': len(products), 'method': method})
+                yield f'{head[:-1]}, "products": [{", ".join(products)}]}}\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route('/similar/<int:product_id>', methods=['GET'])
 def get_similar_products(product_id):
     """Get products similar to a given product"""
     try:
-        if not recommendation_service.product_features:
-            recommendation_service.load_models()
+        if not recommendation_service.ensure_ready():
+            return jsonify({
+                'success': False,
+                'message': 'Models not available. Please train models first.',
+                'products': []
+            }), 503
+        
+        limit = int(request.args.get('limit', 10))
+        try:
+            fields = parse_fields(request.args.get('fields'))
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e), 'products': []}), 400
+        similar_product_ids = recommendation_service.get_similar_product_ids(product_id, limit)
         
-        if product_id not in recommendation_service.product_features:
+        if similar_product_ids is None:
             return jsonify({
                 'success': False,
                 'message': 'Product not found',
                 'products': []
             }), 404
         
-        product_vector = recommendation_service.product_features[product_id]
-        limit = int(request.args.get('limit', 10))
-        
-        # Find similar products
-        product_scores = {}
-        for other_product_id, other_vector in recommendation_service.product_features.items():
-            if other_product_id != product_id:
-                similarity = cosine_similarity(product_vector, other_vector)[0][0]
-                product_scores[other_product_id] = similarity
-        
-        # Sort and get top N
-        sorted_products = sorted(product_scores.items(), key=lambda x: x[1], reverse=True)
-        similar_product_ids = [pid for pid, score in sorted_products[:limit]]
-        
-        # Get product details
-        if similar_product_ids:
-            conn = recommendation_service.get_db_connection()
-            if conn:
-                cursor = conn.cursor(dictionary=True)
-                placeholders = ','.join(['%s'] * len(similar_product_ids))
-                cursor.execute(f"""
-                    SELECT p.*, 
-                           COALESCE(MIN(ps.price), p.price) as min_price,
-                           c.name as category_name
-                    FROM product p
-                    LEFT JOIN product_size ps ON p.product_id = ps.product_id
-                    LEFT JOIN category c ON p.category_id = c.category_id
-                    WHERE p.product_id IN ({placeholders})
-                    AND p.status = 'active'
-                    GROUP BY p.product_id
-                """, similar_product_ids)
-                products = cursor.fetchall()
-                cursor.close()
-            else:
-                products = []
-        else:
-            products = []
+        # Get product details (cached, already JSON-encoded)
+        products = recommendation_service.hydrate_encoded(similar_product_ids, fields)
         
-        return jsonify({
+        return json_with_products({
             'success': True,
-            'products': products,
             'count': len(products)
-        })
+        }, products.values())
         
     except Exception as e:
         return jsonify({
@@ -551,10 +3311,85 @@ def get_similar_products(product_id):
             'products': []
         }), 500
 
+@app.route('/cache/products/invalidate', methods=['POST'])
+def invalidate_product_cache():
+    """Drop cached product details, e.g. after a product is edited in PHP.
+    
+    Body: {"product_ids": [1, 2, 3]}; omit product_ids to clear everything.
+    """
+    data = request.get_json(silent=True) or {}
+    product_ids = data.get('product_ids')
+    if product_ids is not None:
+        try:
+            if not isinstance(product_ids, list):
+                raise TypeError
+            product_ids = [int(pid) for pid in product_ids]
+        except (TypeError, ValueError):
+            return jsonify({
+                'success': False,
+                'message': 'product_ids must be a list of integer product IDs'
+            }), 400
+    removed = recommendation_service.product_cache.invalidate(product_ids)
+    return jsonify({
+        'success': True,
+        'invalidated': removed,
+        'stats': recommendation_service.product_cache.get_stats()
+    })
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Product cache hit-rate statistics"""
+    return jsonify({
+        'success': True,
+        'product_cache': recommendation_service.product_cache.get_stats(),
+        'hybrid_branches': dict(recommendation_service.branch_stats),
+        'result_cache': (
+            recommendation_service.result_cache.get_stats()
+            if recommendation_service.result_cache is not None else None
+        )
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics of this worker process"""
+    model = recommendation_service.model
+    samples = [
+        ('recommendation_model_info', 'gauge',
+         [('version', model.model_version or ''), ('artifact', model.artifact_directory or '')], 1),
+        ('recommendation_model_ready', 'gauge', [], int(recommendation_service.is_ready())),
+        ('recommendation_model_trained_timestamp_seconds', 'gauge', [],
+         model.model_trained_at.timestamp() if model.model_trained_at else 0),
+    ]
+    last_training = recommendation_service.last_training
+    if last_training:
+        samples.append(('recommendation_last_training_duration_seconds', 'gauge',
+                        [('mode', last_training['mode'])], round(last_training['seconds'], 3)))
+    
+    caches = [('product', recommendation_service.product_cache.get_stats())]
+    if recommendation_service.result_cache is not None:
+        caches.append(('result', recommendation_service.result_cache.get_stats()))
+    for name, stats in caches:
+        samples += [
+            ('recommendation_cache_hits_total', 'counter', [('cache', name)], stats['hits']),
+            ('recommendation_cache_misses_total', 'counter', [('cache', name)], stats['misses']),
+            ('recommendation_cache_hit_ratio', 'gauge', [('cache', name)], round(stats['hit_rate'], 4)),
+        ]
+    
+    pool_stats = dict(getattr(recommendation_service.db_pool, 'stats', {}))
+    for key in ('acquired', 'timeouts', 'errors', 'wait_seconds'):
+        value = pool_stats.get(f'{key}_total' if key == 'wait_seconds' else key)
+        if value is not None:
+            samples.append((f'recommendation_db_pool_{key}_total', 'counter', [], value))
+    if 'wait_seconds_max' in pool_stats:
+        samples.append(('recommendation_db_pool_wait_seconds_max', 'gauge', [], pool_stats['wait_seconds_max']))
+    
+    return Response(METRICS.render(samples), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
-    # Load models on startup
-    print("Loading recommendation models...")
-    recommendation_service.load_models()
+    # Load models on startup (trains if none are saved yet)
+    if not recommendation_service.is_ready():
+        print("Loading recommendation models...")
+        recommendation_service.load_models()
     
     # Run Flask app
     print("Starting Flask recommendation service on http://localhost:5000")
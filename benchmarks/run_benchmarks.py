@@ -0,0 +1,270 @@
+"""Benchmark training and the recommendation endpoints on synthetic data
+
+Each scale gets a seeded SQLite database (cached in --data-dir) and runs in a
+fresh process, so peak RSS is per scale. Results are written as JSON; pass an
+earlier result file with --compare to see the change per metric:
+
+    python benchmarks/run_benchmarks.py --scales 10k 100k
+    python benchmarks/run_benchmarks.py --scales 100k --compare benchmarks/results/baseline.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from synthetic_data import DATA_VERSION, SCALES, SQLitePool, generate, table_sizes  # noqa: E402
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far (ru_maxrss is KB on Linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def directory_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total / (1024 * 1024)
+
+
+def summarize(latencies, errors, wall_seconds):
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(float(np.percentile(latencies_ms, 50)), 3),
+        'p99_ms': round(float(np.percentile(latencies_ms, 99)), 3),
+        'mean_ms': round(float(latencies_ms.mean()), 3),
+        'throughput_rps': round(len(latencies) / wall_seconds, 1),
+    }
+
+
+def measure(app, requests, threads):
+    """Send (method, path, json) requests through Flask's test client; returns summary stats"""
+    def send(client, request):
+        method, path, body = request
+        started = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        size = len(response.get_data())  # drains streamed responses
+        return time.perf_counter() - started, response.status_code >= 400, size
+
+    # One request of each kind first so lazy setup is not measured
+    warmup = app.test_client()
+    send(warmup, requests[0])
+
+    started = time.perf_counter()
+    if threads > 1:
+        clients = [app.test_client() for _ in range(threads)]
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            results = list(pool.map(lambda args: send(clients[args[0] % threads], args[1]), enumerate(requests)))
+    else:
+        results = [send(warmup, request) for request in requests]
+    wall_seconds = time.perf_counter() - started
+
+    summary = summarize([seconds for seconds, _, _ in results], sum(failed for _, failed, _ in results), wall_seconds)
+    summary['mean_bytes'] = round(sum(size for _, _, size in results) / len(results))
+    return summary
+
+
+def run_scale(scale, db_path, options):
+    """Train and benchmark one scale; runs in its own process"""
+    # Models, caches and job files go to a scratch directory, not the repo's models/
+    workdir = tempfile.mkdtemp(prefix=f'bench-{scale}-')
+    os.chdir(workdir)
+    os.environ.setdefault('PRELOAD_MODELS', '0')
+    os.environ.setdefault('MODEL_RELOAD_INTERVAL', '0')
+    os.environ.setdefault('RESULT_CACHE_BACKEND', options['result_cache'])
+    sys.path.insert(0, REPO_DIR)
+    import app as app_module
+
+    service = app_module.recommendation_service
+    service.db_pool = SQLitePool(db_path)
+    rss_before = peak_rss_mb()
+
+    started = time.perf_counter()
+    if not service.train_models():
+        raise RuntimeError(f'Training failed at scale {scale}')
+    train_seconds = time.perf_counter() - started
+    rss_after_training = peak_rss_mb()
+
+    # Collaborative filtering alone, once per trainer, on the same interactions
+    interactions = service.load_training_data()[0]
+    cf_train_seconds = {}
+    for trainer in options['cf_trainers']:
+        started = time.perf_counter()
+        app_module.ModelSnapshot().train_collaborative_filtering(interactions, trainer=trainer)
+        cf_train_seconds[trainer] = round(time.perf_counter() - started, 3)
+        print(f"  [{scale}] {trainer} trainer: {cf_train_seconds[trainer]}s")
+    del interactions
+
+    started = time.perf_counter()
+    reloaded = app_module.RecommendationService()
+    reloaded.db_pool = service.db_pool
+    reloaded.load_models()
+    load_seconds = time.perf_counter() - started
+
+    rng = np.random.default_rng(options['seed'])
+    sizes = table_sizes(SCALES[scale])
+    n = options['requests']
+    customers = rng.integers(1, sizes['customers'] + 1, size=n).tolist()
+    products = rng.integers(1, sizes['products'] + 1, size=n).tolist()
+    batch_size = options['batch_size']
+
+    endpoint_requests = {
+        'recommendations_hybrid': [('GET', f'/recommendations/{c}?limit=10', None) for c in customers],
+        'recommendations_collaborative': [
+            ('GET', f'/recommendations/{c}?limit=10&method=collaborative', None) for c in customers
+        ],
+        'recommendations_content': [('GET', f'/recommendations/{c}?limit=10&method=content', None) for c in customers],
+        'recommendations_card': [('GET', f'/recommendations/{c}?limit=10&fields=card', None) for c in customers],
+        # IDs past the generated customers: no orders, views or searches
+        'recommendations_cold': [('GET', f'/recommendations/{sizes["customers"] + c}?limit=10', None) for c in customers],
+        'similar': [('GET', f'/similar/{p}?limit=10', None) for p in products],
+        'recommendations_batch': [
+            ('POST', '/recommendations/batch',
+             {'customer_ids': rng.integers(1, sizes['customers'] + 1, size=batch_size).tolist(), 'limit': 10})
+            for _ in range(max(1, n // batch_size))
+        ],
+    }
+    endpoints = {}
+    for name, requests in endpoint_requests.items():
+        # Cold product cache per endpoint, so hydration cost is included the same way each run
+        service.product_cache.invalidate()
+        endpoints[name] = measure(app_module.app, requests, options['threads'])
+        print(f"  [{scale}] {name}: p50 {endpoints[name]['p50_ms']} ms, "
+              f"p99 {endpoints[name]['p99_ms']} ms, {endpoints[name]['throughput_rps']} req/s, "
+              f"{endpoints[name]['mean_bytes']} bytes")
+
+    return {
+        'scale': scale,
+        'rows': sizes,
+        'train_seconds': round(train_seconds, 3),
+        'cf_train_seconds': cf_train_seconds,
+        'load_seconds': round(load_seconds, 3),
+        'peak_rss_mb': {
+            'before_training': round(rss_before, 1),
+            'after_training': round(rss_after_training, 1),
+            'final': round(peak_rss_mb(), 1),
+        },
+        'artifact_mb': round(directory_mb(app_module.ARTIFACT_DIR), 2),
+        'endpoints': endpoints,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print the relative change of each metric against an earlier result file"""
+    with open(baseline_path) as f:
+        baseline = {entry['scale']: entry for entry in json.load(f)['scales']}
+
+    def change(new, old):
+        return f'{old} -> {new} ({(new - old) / old * 100:+.1f}%)' if old else f'{old} -> {new}'
+
+    for entry in results['scales']:
+        old = baseline.get(entry['scale'])
+        if old is None:
+            continue
+        print(f"\n{entry['scale']} vs {baseline_path}:")
+        print(f"  train_seconds: {change(entry['train_seconds'], old['train_seconds'])}")
+        for trainer, seconds in entry.get('cf_train_seconds', {}).items():
+            if trainer in old.get('cf_train_seconds', {}):
+                print(f"  cf_train_seconds[{trainer}]: {change(seconds, old['cf_train_seconds'][trainer])}")
+        print(f"  peak_rss_mb: {change(entry['peak_rss_mb']['final'], old['peak_rss_mb']['final'])}")
+        for name, stats in entry['endpoints'].items():
+            if name in old['endpoints']:
+                print(f"  {name} p99_ms: {change(stats['p99_ms'], old['endpoints'][name]['p99_ms'])}")
+                if 'mean_bytes' in old['endpoints'][name]:
+                    print(f"  {name} mean_bytes: {change(stats['mean_bytes'], old['endpoints'][name]['mean_bytes'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', nargs='+', default=['10k', '100k'], choices=list(SCALES),
+                        help='data sizes to run, by number of order rows')
+    parser.add_argument('--seed', type=int, default=42, help='seed for the data and the request mix')
+    parser.add_argument('--requests', type=int, default=500, help='requests per endpoint')
+    parser.add_argument('--threads', type=int, default=1, help='concurrent client threads')
+    parser.add_argument('--batch-size', type=int, default=50, help='customers per batch request')
+    parser.add_argument('--result-cache', default='none', choices=['none', 'memory', 'file'],
+                        help='RESULT_CACHE_BACKEND during the run (none measures the scoring path)')
+    parser.add_argument('--cf-trainers', nargs='+', default=['svd', 'als'], choices=['svd', 'als'],
+                        help='collaborative filtering trainers to time separately (CF_TRAINER picks the one served)')
+    parser.add_argument('--data-dir', default=os.path.join(BENCHMARK_DIR, 'data'),
+                        help='where generated SQLite databases are cached')
+    parser.add_argument('--output', help='result JSON path (default: benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--compare', help='earlier result JSON to compare against')
+    args = parser.parse_args()
+
+    options = {
+        'seed': args.seed,
+        'requests': args.requests,
+        'threads': args.threads,
+        'batch_size': args.batch_size,
+        'result_cache': args.result_cache,
+        'cf_trainers': args.cf_trainers,
+    }
+    results = {
+        'created_at': datetime.now().isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'options': options,
+        'scales': [],
+    }
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    for scale in args.scales:
+        db_path = os.path.join(args.data_dir, f'marketplace-{scale}-seed{args.seed}-v{DATA_VERSION}.sqlite3')
+        if not os.path.exists(db_path):
+            print(f"Generating {scale} dataset...")
+            started = time.perf_counter()
+            generate(db_path + '.tmp', SCALES[scale], args.seed)
+            os.replace(db_path + '.tmp', db_path)
+            print(f"  done in {time.perf_counter() - started:.1f}s")
+
+        print(f"Benchmarking {scale}...")
+        # A fresh interpreter per scale keeps peak RSS and imports independent
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            entry = pool.submit(run_scale, scale, db_path, options).result()
+        print(f"  [{scale}] trained in {entry['train_seconds']}s, peak RSS {entry['peak_rss_mb']['final']} MB")
+        results['scales'].append(entry)
+
+    output = args.output or os.path.join(
+        BENCHMARK_DIR, 'results', datetime.now().strftime('%Y%m%dT%H%M%S') + '.json'
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nWrote {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
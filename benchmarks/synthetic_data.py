@@ -0,0 +1,268 @@
+"""Seeded synthetic marketplace data in SQLite, and a stand-in for the MySQL pool
+
+The generated tables carry the columns app.py reads from orders, product,
+category, rating, product_views, user_searches, product_size and seller.
+SQLitePool can replace RecommendationService.db_pool so training, history
+and hydration queries run unchanged against the SQLite file.
+"""
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+# Bumped when the schema changes, so cached databases are regenerated
+DATA_VERSION = 2
+
+# Named scales, in order rows (interactions)
+SCALES = {
+    '10k': 10_000,
+    '100k': 100_000,
+    '1m': 1_000_000,
+    '10m': 10_000_000,
+}
+
+WORDS = (
+    'fresh organic local native rice mango banana pineapple calamansi coconut tomato onion garlic '
+    'ginger eggplant squash cabbage carrot potato fish tilapia bangus shrimp squid pork chicken beef '
+    'egg milk cheese bread pandesal coffee cacao sugar salt vinegar soy sauce noodles dried smoked '
+    'frozen sweet spicy ripe green red white brown small large pack kilo bundle basket jar bottle '
+    'handmade woven bamboo rattan abaca bag mat basket soap candle honey jam peanut butter chips'
+).split()
+CATEGORIES = (
+    'Fruits', 'Vegetables', 'Seafood', 'Meat', 'Poultry', 'Dairy', 'Bakery', 'Beverages',
+    'Condiments', 'Snacks', 'Rice & Grains', 'Frozen', 'Handicrafts', 'Household', 'Personal Care',
+    'Preserves', 'Spices', 'Noodles', 'Eggs', 'Organic',
+)
+ORDER_STATUSES = ('delivered', 'completed', 'confirmed', 'preparing', 'out_for_delivery', 'pending', 'cancelled')
+ORDER_STATUS_WEIGHTS = (0.45, 0.2, 0.08, 0.04, 0.03, 0.1, 0.1)
+
+SCHEMA = """
+CREATE TABLE category (category_id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE seller (seller_id INTEGER PRIMARY KEY, business_name TEXT, firstname TEXT, lastname TEXT);
+CREATE TABLE product (
+    product_id INTEGER PRIMARY KEY, seller_id INTEGER, category_id INTEGER, name TEXT, description TEXT,
+    image TEXT, price REAL, status TEXT, moderation_status TEXT, created_at TEXT
+);
+CREATE TABLE product_size (product_size_id INTEGER PRIMARY KEY, product_id INTEGER, price REAL);
+CREATE TABLE orders (
+    orders_id INTEGER PRIMARY KEY, customer_id INTEGER, product_id INTEGER, quantity INTEGER,
+    status TEXT, payment_status TEXT, created_at TEXT
+);
+CREATE TABLE rating (rating_id INTEGER PRIMARY KEY, orders_id INTEGER, rating INTEGER);
+CREATE TABLE product_views (view_id INTEGER PRIMARY KEY, customer_id INTEGER, product_id INTEGER, viewed_at TEXT);
+CREATE TABLE user_searches (
+    search_id INTEGER PRIMARY KEY, customer_id INTEGER, search_term TEXT, category_id INTEGER, created_at TEXT
+);
+"""
+INDEXES = """
+CREATE INDEX orders_customer ON orders (customer_id);
+CREATE INDEX orders_product ON orders (product_id);
+CREATE INDEX orders_created ON orders (created_at);
+CREATE INDEX rating_order ON rating (orders_id);
+CREATE INDEX product_size_product ON product_size (product_id);
+CREATE INDEX product_views_customer ON product_views (customer_id);
+CREATE INDEX product_views_viewed ON product_views (viewed_at);
+"""
+
+
+# Rows written per executemany call
+INSERT_CHUNK = 200_000
+
+
+def table_sizes(interactions):
+    """Row counts of every table for a given number of order rows"""
+    return {
+        'orders': interactions,
+        'customers': max(50, interactions // 20),
+        'products': max(100, interactions // 50),
+        'categories': len(CATEGORIES),
+        'sellers': max(10, interactions // 2000),
+        'product_views': interactions,
+        'rating': interactions // 10,
+        'user_searches': interactions // 5,
+    }
+
+
+def skewed_ids(rng, n_ids, size, exponent):
+    """size IDs in 1..n_ids drawn with a Zipf-like popularity skew"""
+    weights = 1.0 / np.arange(1, n_ids + 1) ** exponent
+    ranks = rng.choice(n_ids, size=size, p=weights / weights.sum())
+    # Popular IDs are scattered instead of being the lowest ones
+    return rng.permutation(n_ids)[ranks] + 1
+
+
+def timestamps(rng, size, max_days):
+    """size 'YYYY-MM-DD HH:MM:SS' strings within the last max_days days"""
+    now = np.datetime64(datetime.now().replace(microsecond=0), 's')
+    offsets = rng.integers(0, max_days * 86400, size=size).astype('timedelta64[s]')
+    return np.char.replace((now - offsets).astype(str), 'T', ' ')
+
+
+def phrases(rng, size, n_words):
+    """size random phrases of n_words words from WORDS"""
+    picks = rng.integers(0, len(WORDS), size=(size, n_words))
+    words = np.array(WORDS)
+    return [' '.join(row) for row in words[picks]]
+
+
+def insert(db, table, columns):
+    """Insert column arrays into table in chunks"""
+    n = len(columns[0])
+    placeholders = ','.join('?' * len(columns))
+    for start in range(0, n, INSERT_CHUNK):
+        chunk = [np.asarray(column[start:start + INSERT_CHUNK]).tolist() for column in columns]
+        db.executemany(f'INSERT INTO {table} VALUES ({placeholders})', zip(*chunk))
+
+
+def generate(path, interactions, seed=42):
+    """Write a synthetic marketplace database with `interactions` order rows to path"""
+    rng = np.random.default_rng(seed)
+    sizes = table_sizes(interactions)
+    n_customers, n_products = sizes['customers'], sizes['products']
+
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    db.executescript('PRAGMA journal_mode = OFF; PRAGMA synchronous = OFF;' + SCHEMA)
+
+    insert(db, 'category', [np.arange(1, len(CATEGORIES) + 1), list(CATEGORIES)])
+    seller_ids = np.arange(1, sizes['sellers'] + 1)
+    insert(db, 'seller', [
+        seller_ids, [f'Seller {i} Store' for i in seller_ids],
+        [f'First{i}' for i in seller_ids], [f'Last{i}' for i in seller_ids]
+    ])
+
+    product_ids = np.arange(1, n_products + 1)
+    categories = rng.integers(1, len(CATEGORIES) + 1, size=n_products)
+    prices = np.round(rng.lognormal(4.5, 0.8, size=n_products), 2)
+    insert(db, 'product', [
+        product_ids,
+        rng.integers(1, sizes['sellers'] + 1, size=n_products),
+        categories,
+        phrases(rng, n_products, 3),
+        phrases(rng, n_products, 12),
+        [f'product_{i}.jpg' for i in product_ids],
+        prices,
+        np.where(rng.random(n_products) < 0.95, 'active', 'inactive'),
+        np.where(rng.random(n_products) < 0.9, 'approved', 'pending'),
+        timestamps(rng, n_products, 730),
+    ])
+    # A second size at a lower price for a third of the products
+    sized = product_ids[rng.random(n_products) < 0.33]
+    insert(db, 'product_size', [
+        np.arange(1, len(sized) + 1), sized, np.round(prices[sized - 1] * 0.8, 2)
+    ])
+
+    n_orders = sizes['orders']
+    insert(db, 'orders', [
+        np.arange(1, n_orders + 1),
+        skewed_ids(rng, n_customers, n_orders, 0.6),
+        skewed_ids(rng, n_products, n_orders, 0.9),
+        rng.integers(1, 6, size=n_orders),
+        np.array(ORDER_STATUSES)[rng.choice(len(ORDER_STATUSES), size=n_orders, p=ORDER_STATUS_WEIGHTS)],
+        np.where(rng.random(n_orders) < 0.9, 'paid', 'unpaid'),
+        timestamps(rng, n_orders, 365),
+    ])
+
+    n_ratings = sizes['rating']
+    insert(db, 'rating', [
+        np.arange(1, n_ratings + 1),
+        rng.choice(n_orders, size=n_ratings, replace=False) + 1,
+        rng.choice(5, size=n_ratings, p=(0.05, 0.05, 0.15, 0.35, 0.4)) + 1,
+    ])
+
+    n_views = sizes['product_views']
+    insert(db, 'product_views', [
+        np.arange(1, n_views + 1),
+        skewed_ids(rng, n_customers, n_views, 0.6),
+        skewed_ids(rng, n_products, n_views, 0.7),
+        timestamps(rng, n_views, 180),
+    ])
+
+    n_searches = sizes['user_searches']
+    insert(db, 'user_searches', [
+        np.arange(1, n_searches + 1),
+        skewed_ids(rng, n_customers, n_searches, 0.6),
+        phrases(rng, n_searches, 2),
+        rng.integers(1, len(CATEGORIES) + 1, size=n_searches),
+        timestamps(rng, n_searches, 120),
+    ])
+
+    db.executescript(INDEXES)
+    db.commit()
+    db.close()
+    return sizes
+
+
+# MySQL syntax used by app.py that SQLite spells differently
+DATE_SUB = re.compile(r'DATE_SUB\(NOW\(\), INTERVAL (\d+) DAY\)')
+
+
+class SQLiteCursor:
+    """mysql.connector-style cursor over sqlite3 (%s placeholders, dictionary rows)"""
+
+    def __init__(self, conn, dictionary=False):
+        self._cursor = conn.cursor()
+        self.dictionary = dictionary
+
+    def execute(self, query, params=()):
+        query = DATE_SUB.sub(lambda m: f"datetime('now', '-{m.group(1)} days')", query).replace('%s', '?')
+        params = [p.strftime('%Y-%m-%d %H:%M:%S') if isinstance(p, datetime) else p for p in params]
+        self._cursor.execute(query, params)
+
+    def _rows(self, rows):
+        if not self.dictionary:
+            return rows
+        names = [column[0] for column in self._cursor.description]
+        return [dict(zip(names, row)) for row in rows]
+
+    def fetchall(self):
+        return self._rows(self._cursor.fetchall())
+
+    def fetchmany(self, size=1):
+        return self._rows(self._cursor.fetchmany(size))
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, dictionary=False, **kwargs):
+        return SQLiteCursor(self._conn, dictionary)
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class SQLitePool:
+    """Stand-in for app.ConnectionPool: one read-only SQLite connection per thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.stats = {'acquired': 0}
+
+    @contextmanager
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(f'file:{os.path.abspath(self.path)}?mode=ro', uri=True)
+        self.stats['acquired'] += 1
+        yield SQLiteConnection(conn)
+
+    def get_stats(self):
+        return dict(self.stats)
@@ -0,0 +1,13 @@
+"""Gunicorn settings, picked up automatically by `gunicorn app:app` (see Procfile)"""
+import os
+
+# Import app.py (and memory-map the saved model) once in the master, so every
+# worker is ready as soon as it forks and all of them share the model's pages
+preload_app = os.getenv('PRELOAD_MODELS', '1') != '0'
+
+
+def post_fork(server, worker):
+    # Start checking for models saved by other workers right away instead of
+    # on the worker's first request
+    from app import recommendation_service
+    recommendation_service.start_model_watcher()
@@ -0,0 +1,93 @@
+"""Precompute top-N hybrid recommendations for every known customer
+
+Run after training (or with --train) so /recommendations can answer from the
+memory-mapped table in models/precomputed instead of scoring live:
+
+    python precompute_recommendations.py --train --top-n 10 --workers 4
+
+Only requests whose limit equals --top-n are served from the table (the
+hybrid ranking depends on the list length), so match the limit the PHP side
+sends.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from app import recommendation_service, PrecomputedStore, PRECOMPUTED_DIR
+
+
+def init_worker(version):
+    """Make sure a spawned worker has the saved model; forked workers inherit it.
+
+    Workers only ever load the artifact (never train), and refuse to score
+    with a different model version than the one the table is labelled with.
+    """
+    if not recommendation_service.is_ready():
+        recommendation_service.preload_models()
+    if recommendation_service.model_version != version:
+        raise RuntimeError(f"Worker loaded model {recommendation_service.model_version}, expected {version}")
+    # Bulk scoring should not fill the request-path result cache
+    recommendation_service.result_cache = None
+
+
+def recommend_chunk(args):
+    customer_ids, top_n = args
+    return recommendation_service.get_recommendations_batch(customer_ids, 'hybrid', top_n)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--train', action='store_true', help='retrain models before precomputing')
+    parser.add_argument('--top-n', type=int, default=10,
+                        help='recommendations stored per customer; served only for this exact limit')
+    parser.add_argument('--chunk-size', type=int, default=256, help='customers scored per task')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--output', default=PRECOMPUTED_DIR, help='directory for the table and manifest')
+    args = parser.parse_args()
+
+    if args.train:
+        if not recommendation_service.train_models():
+            print("Training failed")
+            return 1
+    elif not recommendation_service.preload_models():
+        print("Models not available. Train first, or pass --train.")
+        return 1
+
+    version = recommendation_service.model_version
+    customer_ids = sorted(recommendation_service.user_to_idx)
+    if not customer_ids:
+        print("No customers in the collaborative filtering model")
+        return 1
+
+    chunks = [
+        (customer_ids[start:start + args.chunk_size], args.top_n)
+        for start in range(0, len(customer_ids), args.chunk_size)
+    ]
+    print(f"Precomputing top-{args.top_n} for {len(customer_ids)} customers "
+          f"in {len(chunks)} chunks on {args.workers} workers...")
+
+    started = time.perf_counter()
+    recommendations = {}
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                 initargs=(version,)) as pool:
+            for done, result in enumerate(pool.map(recommend_chunk, chunks), start=1):
+                recommendations.update(result)
+                print(f"  {done}/{len(chunks)} chunks", end='\r')
+    else:
+        init_worker(version)
+        for done, chunk in enumerate(chunks, start=1):
+            recommendations.update(recommend_chunk(chunk))
+            print(f"  {done}/{len(chunks)} chunks", end='\r')
+    print()
+
+    retrieval = recommendation_service.hybrid_retrieval()
+    manifest = PrecomputedStore(args.output).publish(recommendations, version, args.top_n, retrieval)
+    print(f"Wrote {manifest['customers']} customers to {args.output}/{manifest['file']} "
+          f"in {time.perf_counter() - started:.1f}s (model {version})")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
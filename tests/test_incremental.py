@@ -0,0 +1,148 @@
+"""Incremental training must leave touched customers exactly as a full retrain would
+
+Runs against a small seeded SQLite marketplace (benchmarks/synthetic_data.py):
+
+    python -m pytest tests
+"""
+import os
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+sys.path.insert(0, REPO_DIR)
+
+os.environ.setdefault('PRELOAD_MODELS', '0')
+os.environ.setdefault('MODEL_RELOAD_INTERVAL', '0')
+os.environ.setdefault('RESULT_CACHE_BACKEND', 'none')
+
+import app  # noqa: E402
+from synthetic_data import SQLitePool, generate  # noqa: E402
+
+INTERACTIONS = 5000
+# Placed (unpaid) three days before training, paid after it
+LATE_ORDER_ID = INTERACTIONS + 1
+LATE_CUSTOMER = 3
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Path of a freshly generated database; models are written under tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / 'marketplace.sqlite3')
+    generate(path, INTERACTIONS, seed=42)
+
+    db = sqlite3.connect(path)
+    (product_id,) = db.execute("""
+        SELECT MIN(product_id) FROM product WHERE product_id NOT IN (
+            SELECT product_id FROM orders WHERE customer_id = ? AND payment_status = 'paid'
+        )
+    """, (LATE_CUSTOMER,)).fetchone()
+    db.execute('INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?)', (
+        LATE_ORDER_ID, LATE_CUSTOMER, product_id, 2, 'pending', 'unpaid',
+        sql_time(datetime.now() - timedelta(days=3))
+    ))
+    db.commit()
+    db.close()
+    return path
+
+
+def trained_service(path):
+    service = app.RecommendationService()
+    service.db_pool = SQLitePool(path)
+    assert service.train_models()
+    return service
+
+
+def sql_time(moment):
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def insert_activity(path):
+    """Write new orders, views and searches.
+
+    Returns (IDs of customers with new or newly paid orders, IDs of every
+    touched customer, the product of the late-paid order).
+    """
+    now = sql_time(datetime.now())
+    db = sqlite3.connect(path)
+    (last_order,) = db.execute('SELECT MAX(orders_id) FROM orders').fetchone()
+    (new_customer,) = db.execute('SELECT MAX(customer_id) + 1 FROM orders').fetchone()
+    (late_product,) = db.execute('SELECT product_id FROM orders WHERE orders_id = ?', (LATE_ORDER_ID,)).fetchone()
+    db.executemany('INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?)', [
+        (last_order + 1, 1, 5, 2, 'delivered', 'paid', now),
+        (last_order + 2, 1, 7, 1, 'completed', 'paid', now),
+        (last_order + 3, 2, 5, 3, 'confirmed', 'paid', now),
+        (last_order + 4, new_customer, 9, 1, 'delivered', 'paid', now),
+        (last_order + 5, new_customer, 11, 4, 'delivered', 'paid', now),
+    ])
+    db.execute("UPDATE orders SET status = 'delivered', payment_status = 'paid' WHERE orders_id = ?",
+               (LATE_ORDER_ID,))
+    db.executemany('INSERT INTO product_views (customer_id, product_id, viewed_at) VALUES (?, ?, ?)', [
+        (2, 21, now), (4, 23, now), (new_customer, 25, now),
+    ])
+    db.executemany(
+        'INSERT INTO user_searches (customer_id, search_term, category_id, created_at) VALUES (?, ?, ?, ?)', [
+            (1, 'fresh mango', 1, now), (4, 'woven bamboo basket', 13, now), (new_customer, 'coffee', 8, now),
+        ]
+    )
+    db.commit()
+    db.close()
+    return [1, 2, LATE_CUSTOMER, new_customer], [1, 2, LATE_CUSTOMER, 4, new_customer], late_product
+
+
+def matrix_row(model, customer_id):
+    """{product_id: value} of a customer's user-item matrix row"""
+    row = model.user_item_matrix[model.user_to_idx[customer_id]]
+    return dict(zip(model.idx_to_product[row.indices].tolist(), row.data.tolist()))
+
+
+def history(model, customer_id):
+    """(product IDs, dense content profile) of a customer's history"""
+    i = np.searchsorted(model.history_customers, customer_id)
+    assert model.history_customers[i] == customer_id
+    products = model.history_products[model.history_indptr[i]:model.history_indptr[i + 1]]
+    return products.tolist(), model.history_profiles[i].toarray().ravel()
+
+
+def search_profile(model, customer_id):
+    i = np.searchsorted(model.search_customers, customer_id)
+    assert model.search_customers[i] == customer_id
+    return model.search_profiles[i].toarray().ravel()
+
+
+def test_incremental_matches_full_retrain(database):
+    service = trained_service(database)
+    ordered, touched, _ = insert_activity(database)
+
+    assert service.update_models_incremental()
+    incremental = service.model
+    assert incremental.model_full_trained_at < incremental.model_trained_at
+    full = trained_service(database).model
+
+    for customer_id in ordered:
+        assert matrix_row(incremental, customer_id) == pytest.approx(matrix_row(full, customer_id))
+
+    for customer_id in touched:
+        incremental_products, incremental_profile = history(incremental, customer_id)
+        full_products, full_profile = history(full, customer_id)
+        assert incremental_products == full_products
+        np.testing.assert_allclose(incremental_profile, full_profile, rtol=1e-5, atol=1e-6)
+
+    for customer_id in (1, 4, ordered[-1]):
+        np.testing.assert_allclose(search_profile(incremental, customer_id), search_profile(full, customer_id),
+                                   rtol=1e-5, atol=1e-6)
+
+
+def test_incremental_picks_up_late_payment(database):
+    service = trained_service(database)
+    _, _, late_product = insert_activity(database)
+    assert late_product not in matrix_row(service.model, LATE_CUSTOMER)
+
+    assert service.update_models_incremental()
+    assert late_product in matrix_row(service.model, LATE_CUSTOMER)